@@ -0,0 +1,385 @@
+"""Client for the Open Library API.
+
+Every call to Open Library goes through `client`, which keeps a pool of
+keep-alive connections, sets timeouts, retries transient failures with
+jittered backoff and counts calls, errors and time spent per endpoint.
+
+It also keeps Open Library from tying up the app when it is down or slow.
+Each endpoint has a circuit breaker that stops calling it for a while
+after repeated failures, and each request has an upstream time budget
+that all its calls share. Calls that aren't made raise
+UpstreamUnavailable, a RequestException, so callers fall back the same
+way they do for any other failed call.
+"""
+
+import itertools
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import g
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import record_upstream
+
+API_URL = "https://openlibrary.org"
+COVERS_URL = "https://covers.openlibrary.org"
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_deadline = ContextVar("upstream_deadline", default=None)
+
+
+class UpstreamUnavailable(requests.RequestException):
+    """Open Library wasn't called: the endpoint's circuit is open or the
+    request has used up its upstream time budget."""
+
+
+class CircuitBreaker:
+    """Stops calls to an endpoint that keeps failing.
+
+    After `threshold` failures in a row the circuit opens and calls are
+    refused for `cooldown` seconds. Then it is half open: one call goes
+    through as a probe, and closes the circuit if it works or opens it
+    again if it doesn't.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go ahead. Must be followed by success(),
+        failure() or cancel() when it does."""
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if (self.state == self.OPEN
+                    and time.monotonic() - self.opened_at >= self.cooldown):
+                self.state = self.HALF_OPEN
+                return True
+
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def cancel(self):
+        """A call that proved nothing either way. A probe's turn passes to
+        the next call."""
+
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+def start_budget(seconds):
+    """Give the Open Library calls made in the current context (and the
+    threads it is copied to) `seconds` in all, from now. None for no
+    limit. Returns a token for end_budget."""
+
+    return _deadline.set(None if seconds is None else time.monotonic() + seconds)
+
+
+def end_budget(token):
+    """Go back to the budget (or none) from before start_budget."""
+
+    _deadline.reset(token)
+
+
+def init_upstream_budget(app):
+    """Give each request UPSTREAM_BUDGET seconds of Open Library calls."""
+
+    @app.before_request
+    def start_upstream_budget():
+        g.upstream_budget = start_budget(app.config.get("UPSTREAM_BUDGET"))
+
+    @app.teardown_request
+    def end_upstream_budget(error):
+        token = g.pop("upstream_budget", None)
+        if token is not None:
+            end_budget(token)
+
+
+def make_session(pool_size):
+    # no retries here: OpenLibraryClient.get retries within the budget
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "User-Agent": "TheBookList/1.0",
+    })
+
+    return session
+
+
+def retry_after(resp):
+    """The seconds a 429 or 503 response asks us to wait, or 0."""
+
+    if resp is None or resp.status_code not in (429, 503):
+        return 0
+
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After", 0)))
+    except (TypeError, ValueError):
+        # an HTTP date; not worth waiting for
+        return 0
+
+
+class OpenLibraryClient:
+    """Pooled, instrumented HTTP client for Open Library."""
+
+    def __init__(self, base_url=API_URL, covers_url=COVERS_URL,
+                 connect_timeout=3.05, read_timeout=10, retries=2,
+                 pool_size=32, breaker_threshold=5, breaker_cooldown=30,
+                 backoff_factor=0.2, backoff_jitter=0.2):
+        self.base_url = base_url.rstrip("/")
+        self.covers_url = covers_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_jitter = backoff_jitter
+        self.stats = {}
+        self.breakers = {}
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._lock = threading.Lock()
+
+        self.session = make_session(pool_size)
+
+    @classmethod
+    def from_env(cls):
+        """Build a client configured from OPENLIBRARY_* environment variables."""
+
+        return cls(
+            base_url=os.environ.get("OPENLIBRARY_URL", API_URL),
+            covers_url=os.environ.get("OPENLIBRARY_COVERS_URL", COVERS_URL),
+            connect_timeout=float(
+                os.environ.get("OPENLIBRARY_CONNECT_TIMEOUT", 3.05)),
+            read_timeout=float(os.environ.get("OPENLIBRARY_READ_TIMEOUT", 10)),
+            retries=int(os.environ.get("OPENLIBRARY_RETRIES", 2)),
+            pool_size=int(os.environ.get("OPENLIBRARY_POOL_SIZE", 32)),
+            breaker_threshold=int(
+                os.environ.get("OPENLIBRARY_BREAKER_THRESHOLD", 5)),
+            breaker_cooldown=float(
+                os.environ.get("OPENLIBRARY_BREAKER_COOLDOWN", 30)),
+        )
+
+    def breaker(self, endpoint):
+        """The circuit breaker for `endpoint`."""
+
+        with self._lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None:
+                breaker = self.breakers[endpoint] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_cooldown)
+
+        return breaker
+
+    def budgeted_timeout(self):
+        """The (connect, read) timeout for a call now, each cut to what is
+        left of the current budget, and which of the two were cut. Raises
+        UpstreamUnavailable when nothing is left."""
+
+        deadline = _deadline.get()
+        if deadline is None:
+            return self.timeout, (False, False)
+
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise UpstreamUnavailable("upstream time budget used up")
+
+        timeout = tuple(min(t, left) for t in self.timeout)
+        cut = tuple(left < t for t in self.timeout)
+
+        return timeout, cut
+
+    def retry_delay(self, error, attempt):
+        """How long to wait before retrying after `error` on try `attempt`
+        (0 for the first), or None to give up.
+
+        Connection errors, timeouts and 429/5xx responses are retried, at
+        once the first time and with jittered exponential backoff after
+        that. A retry is only made if, after the wait, the budget still
+        outlasts a timed out connect.
+        """
+
+        if attempt >= self.retries:
+            return None
+
+        if isinstance(error, requests.HTTPError):
+            resp = error.response
+            if resp is None or resp.status_code not in RETRY_STATUSES:
+                return None
+        elif not isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return None
+
+        delay = 0.0
+        if attempt:
+            delay = (self.backoff_factor * 2 ** attempt
+                     + random.random() * self.backoff_jitter)
+        delay = max(delay, retry_after(getattr(error, "response", None)))
+
+        deadline = _deadline.get()
+        if deadline is None:
+            # Retry-After can ask for anything; wait no longer than we
+            # would for a slow response
+            return delay if delay <= self.timeout[1] else None
+
+        if deadline - time.monotonic() - delay <= self.timeout[0]:
+            return None
+
+        return delay
+
+    def _record(self, endpoint, seconds, error):
+        with self._lock:
+            stat = self.stats.setdefault(
+                endpoint, {"calls": 0, "errors": 0, "seconds": 0.0})
+            stat["calls"] += 1
+            stat["seconds"] += seconds
+            if error:
+                stat["errors"] += 1
+
+        record_upstream(seconds)
+
+    def get(self, endpoint, url, params=None):
+        """GET `url` and return the response.
+
+        `endpoint` names the kind of call for the counters and its circuit
+        breaker. Raises a requests.RequestException on network errors and
+        error statuses, and UpstreamUnavailable without calling when the
+        circuit is open or the request's budget is used up.
+        """
+
+        timeout, (connect_cut, read_cut) = self.budgeted_timeout()
+
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            raise UpstreamUnavailable(f"circuit open for {endpoint}")
+
+        start = time.perf_counter()
+        error = True
+
+        try:
+            for attempt in itertools.count():
+                try:
+                    resp = self.session.get(url, params=params, timeout=timeout)
+                    resp.raise_for_status()
+                    break
+                except requests.RequestException as e:
+                    delay = self.retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+
+                time.sleep(delay)
+                # each try gets only what is left of the budget
+                timeout, (connect_cut, read_cut) = self.budgeted_timeout()
+
+            error = False
+            breaker.success()
+            return resp
+
+        except requests.HTTPError as e:
+            # anything but a server error means Open Library is up
+            if e.response is not None and e.response.status_code in RETRY_STATUSES:
+                breaker.failure()
+            else:
+                breaker.success()
+            raise
+
+        except requests.Timeout as e:
+            # a timeout cut short by the budget says little about Open Library
+            if connect_cut if isinstance(e, requests.ConnectTimeout) else read_cut:
+                breaker.cancel()
+            else:
+                breaker.failure()
+            raise
+
+        except UpstreamUnavailable:
+            breaker.cancel()
+            raise
+
+        except requests.RequestException:
+            breaker.failure()
+            raise
+
+        except BaseException:
+            breaker.cancel()
+            raise
+
+        finally:
+            self._record(endpoint, time.perf_counter() - start, error)
+
+    def get_json(self, endpoint, path, params=None):
+        """GET `path` and return the decoded JSON body.
+
+        `endpoint` names the kind of call for the counters. Raises a
+        requests.RequestException on network errors and error statuses.
+        """
+
+        return self.get(endpoint, f"{self.base_url}{path}", params).json()
+
+    def work(self, key):
+        """Get the work record for `key` (e.g. OL45804W)."""
+
+        return self.get_json("works", f"/works/{key}.json")
+
+    def author(self, author_key):
+        """Get the author record for `author_key` (e.g. /authors/OL23919A)."""
+
+        return self.get_json("authors", f"{author_key}.json")
+
+    def search(self, params):
+        """Run a search.json query."""
+
+        return self.get_json("search", "/search.json", params=params)
+
+    def cover(self, cover_id, size="M"):
+        """Get the cover image `cover_id` in `size` (S, M or L) as bytes.
+
+        Covers Open Library doesn't have raise an HTTPError (404).
+        """
+
+        return self.get("covers", f"{self.covers_url}/b/id/{cover_id}-{size}.jpg",
+                        params={"default": "false"}).content
+
+    def trending(self, limit=15):
+        """Get works trending now."""
+
+        return self.get_json("trending", "/trending/now.json",
+                             params={"limit": limit})
+
+
+client = OpenLibraryClient.from_env()
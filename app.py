@@ -1,16 +1,35 @@
+import asyncio
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
+import click
+from flask import (Flask, render_template, stream_template, request, flash,
+                   redirect, session, g, abort, send_file,
+                   get_flashed_messages)
 from flask_debugtoolbar import DebugToolbarExtension
+from requests import RequestException
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from forms import UserAddForm, LoginForm,UserProfileForm, ReviewForm
-from models import db, connect_db, User, Review, Like
-import requests
-
-from helpers import make_books_from_likes
+from models import db, connect_db, upgrade_db, User, Review, Like, Book, BookAuthor
+from api_helpers import client, init_upstream_budget
+from instrumentation import (init_query_budget, init_metrics, openlibrary_lines,
+                             breaker_lines, cache_lines, password_lines)
+from http_caching import (init_http_caching, cache_control, render_cached,
+                          static_url)
+from fragments import init_fragments, fragments
+from dataloader import init_loaders
+
+from helpers import (make_book_async, make_books, make_books_from_likes,
+                     save_book_quietly, get_trending, refresh_trending,
+                     start_trending_refresher, search_books, get_cover,
+                     COVER_SIZES, cache, covers, cover_flight, export_cache,
+                     import_cache, iter_books, catalog_rows, likes_catalog_rows)
+from passwords import stats as password_stats
 
 CURR_USER_KEY = "curr_user"
+CURR_USERNAME_KEY = "curr_username"
 
 app = Flask(__name__)
 
@@ -23,40 +42,149 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "thr4%jfjLLndneoo*&rt!ffh")
+app.config['READERS_PAGE_SIZE'] = int(os.environ.get('READERS_PAGE_SIZE', 24))
+app.config['REVIEWS_PAGE_SIZE'] = int(os.environ.get('REVIEWS_PAGE_SIZE', 20))
+# serve cached covers through nginx: set to the internal location that maps
+# to COVER_CACHE_DIR, e.g. /_covers/
+app.config['COVER_ACCEL_REDIRECT'] = os.environ.get('COVER_ACCEL_REDIRECT')
+# tests can set this to fail any request that runs more SQL queries
+app.config['SQL_QUERY_BUDGET'] = None
+# add a Server-Timing header (app, db and openlibrary time) to responses
+app.config['SERVER_TIMING'] = bool(os.environ.get('SERVER_TIMING'))
+# when set, /metrics needs "Authorization: Bearer <METRICS_TOKEN>"
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# send the likes and readers pages as they render; STREAM_LIST_PAGES=0
+# renders them whole first
+app.config['STREAM_LIST_PAGES'] = os.environ.get('STREAM_LIST_PAGES', '1') != '0'
+# seconds of Open Library calls each request may make in all; once they
+# are used up the page makes do with what is cached
+app.config['UPSTREAM_BUDGET'] = float(os.environ.get('UPSTREAM_BUDGET', 5))
 #astoolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+init_query_budget(app)
+init_metrics(app, collectors=[
+    lambda: openlibrary_lines(client.stats),
+    lambda: breaker_lines(client.breakers),
+    lambda: cache_lines(
+        {"local": cache.local, "shared": cache.shared,
+         "fragments": fragments, "covers": covers},
+        {"book": cache.flight, "covers": cover_flight}),
+    lambda: password_lines(password_stats),
+])
+init_http_caching(app)
+init_fragments(app)
+init_loaders(app)
+init_upstream_budget(app)
+
+# CACHE_SNAPSHOT=<file> loads a snapshot from `flask cache-export` into the
+# cache before the app serves anything
+if os.environ.get('CACHE_SNAPSHOT'):
+    try:
+        loaded = import_cache(os.environ['CACHE_SNAPSHOT'])
+        app.logger.info("Loaded %d cache entries from %s", loaded,
+                        os.environ['CACHE_SNAPSHOT'])
+    except (OSError, ValueError):
+        app.logger.exception("Loading the cache snapshot failed")
+
+# TRENDING_WARM=1 fills the trending cache before the app serves anything
+if os.environ.get('TRENDING_WARM'):
+    try:
+        refresh_trending()
+    except RequestException:
+        app.logger.exception("Warming the trending cache failed")
+    start_trending_refresher()
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Add new tables, indexes and constraints to an existing database."""
+
+    upgrade_db()
+
+
+@app.cli.command('cache-export')
+@click.argument('path')
+def cache_export_command(path):
+    """Write the cached Open Library data to a snapshot file."""
+
+    print(f"Wrote {export_cache(path)} entries to {path}")
+
+
+@app.cli.command('cache-import')
+@click.argument('path')
+@click.option('--ttl', type=int,
+              help='Keep every entry this many seconds, even expired ones.')
+def cache_import_command(path, ttl):
+    """Load a snapshot file into the cache."""
+
+    print(f"Loaded {import_cache(path, ttl)} entries from {path}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+class CurrentUser:
+    """The logged in user, as remembered in the session.
+
+    Only has the id and username, which is all most pages need. Routes
+    that need the whole User row get it with load().
+    """
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+        self._user = None
+
+    def load(self):
+        """Get the full User row (None if it has since been deleted)."""
+
+        if self._user is None:
+            self._user = User.query.get(self.id)
+
+        return self._user
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if CURR_USER_KEY not in session:
+        g.user = None
+
+    elif CURR_USERNAME_KEY in session:
+        g.user = CurrentUser(session[CURR_USER_KEY],
+                             session[CURR_USERNAME_KEY])
 
     else:
-        g.user = None
+        # logged in before usernames were kept in the session
+        user = User.query.get(session[CURR_USER_KEY])
+
+        if user:
+            do_login(user)
+            g.user = CurrentUser(user.id, user.username)
+        else:
+            do_logout()
+            g.user = None
 
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USERNAME_KEY] = user.username
 
 
 def do_logout():
     """Logout user."""
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    session.pop(CURR_USER_KEY, None)
+    session.pop(CURR_USERNAME_KEY, None)
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@cache_control("no-store")
 def signup():
     """Handle user signup.
 
@@ -94,6 +222,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@cache_control("no-store")
 def login():
     """Handle user login."""
 
@@ -104,6 +233,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # keeps a password hash upgraded to the current bcrypt cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/books/trending")
@@ -124,6 +255,11 @@ def logout():
 ##############################################################################
 # General user routes:
 
+# load a like's book and its authors from the local catalog in the same query
+with_book = (joinedload(Like.book)
+             .joinedload(Book.book_authors)
+             .joinedload(BookAuthor.author))
+
 
 @app.route('/users/<int:user_id>/likes')
 def users_likes(user_id):
@@ -135,158 +271,128 @@ def users_likes(user_id):
 
     likes = (Like
             .query
+            .options(with_book)
             .filter(Like.user_id == user_id)
             .all())
-    books =  make_books_from_likes(likes)
 
+    if app.config['STREAM_LIST_PAGES']:
+        books = iter_books([like.book_key for like in likes],
+                           likes_catalog_rows(likes))
+        return stream_page("/users/likes.html", books=books, count=len(likes))
 
-    return render_template("/users/likes.html", books=books)
+    books = make_books_from_likes(likes)
+
+    return render_template("/users/likes.html", books=books, count=len(books))
 
 @app.route('/users/<int:user_id>/readers')
 def readers_likes(user_id):
-    """Show list of likes of all readers."""
+    """Show what other readers are reading, a page at a time.
+
+    Sorted by number of readers, or by most recently liked with
+    ?order=recent. ?after= takes the cursor of the previous page.
+    """
  
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    
 
-    likes = (Like
-            .query
-            .filter(Like.user_id != user_id)
-            .all())
-    
-    books = make_books_from_likes(likes)
+    order = request.args.get('order', 'popular')
+    if order not in ('popular', 'recent'):
+        order = 'popular'
 
+    after = parse_readers_cursor(request.args.get('after'), order)
+    page_size = app.config['READERS_PAGE_SIZE']
 
-    return render_template("/users/readers.html", books=books)
+    # get one extra row to know whether there is a next page
+    rows = Like.book_counts(user_id, order, after, page_size + 1)
+    next_cursor = None
 
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        if order == 'recent':
+            next_cursor = f"{last.last_like}"
+        else:
+            next_cursor = f"{last.readers}:{last.book_key}"
 
-@app.route('/users/<int:user_id>/<key>', methods=["GET"])
-def users_book_details(user_id,key):
-    """ Show a book's details"""
-    
-    if not g.user or g.user.id != int(user_id):
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+    keys = [row.book_key for row in rows]
+    context = dict(count=len(rows), order=order, next_cursor=next_cursor)
 
-    resp = requests.get(
-            f"https://openlibrary.org/works/{key}.json",
-            params={}
-       )
-       
-    resp = resp.json()
+    if app.config['STREAM_LIST_PAGES']:
+        books = iter_books(keys, catalog_rows(keys))
+        books = (dict(book, readers=row.readers) for book, row in zip(books, rows))
+        return stream_page("/users/readers.html", books=books, **context)
 
-    # make sure there is a description
-    desc = resp.get("description", 'No description')
-  
-    if isinstance(desc, dict):
-        desc = desc.get("value",'No description')
+    books = make_books(keys)
+    books = [dict(book, readers=row.readers) for book, row in zip(books, rows)]
 
-    # make sure there is a cover
-    cover = resp.get("covers", ['No image available'])
-    cover = cover[0]
+    return render_template("/users/readers.html", books=books, **context)
 
-    # make sure there is a published date
-    published = resp.get("first_publish_date", 'No date available')
 
-    authors = []
+def stream_page(template, **context):
+    """Send `template` to the browser as it renders, so the page shell and
+    the first cards arrive while the rest are still being fetched.
 
-    for author in resp['authors']:
-        authorResp = requests.get(
-            f"https://openlibrary.org/{author['author']['key']}.json",
-            params={}
-        )
+    Only from sync views: stream_with_context can't carry the request
+    context out of the thread an async view runs in.
+    """
 
-        authorResp = authorResp.json()
+    # take the flashed messages out of the session now: it's saved before
+    # the body is sent, and they'd show again on the next page otherwise
+    get_flashed_messages()
 
-        authors.append(authorResp['name'])
-        authors = list(set(authors ))
+    response = app.response_class(stream_template(template, **context))
+    # or nginx holds the page back until it is complete
+    response.headers['X-Accel-Buffering'] = 'no'
 
-    # get reviews and user associated with book
-    reviews = (Review
-            .query
-            .filter(Review.book_key == key)
-            .order_by(Review.timestamp.desc())
-            .limit(100)
-            .all())
-    
+    return response
 
-    book = {
-        "title": resp['title'],
-        "published": published,
-        "description": desc,
-        "authors" : authors,
-        "cover" : cover,
-        "key" : key,
-        "reviews" : reviews,
-        "user_id" : user_id
-    }
 
-    return render_template('users/book.html', book=book)
+def parse_readers_cursor(cursor, order):
+    """Turn an ?after= cursor from the readers page back into a sort key.
 
-@app.route('/users/<int:user_id>/<key>/readers', methods=["GET"])
-def readers_book_details(user_id,key):
-    """ Show a book's details"""
-    
-    if not g.user or g.user.id != int(user_id):
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+    Anything malformed starts from the first page.
+    """
 
-    resp = requests.get(
-            f"https://openlibrary.org/works/{key}.json",
-            params={}
-       )
-       
-    resp = resp.json()
+    if not cursor:
+        return None
 
-    # make sure there is a description
-    desc = resp.get("description", 'No description')
-  
-    if isinstance(desc, dict):
-        desc = desc.get("value",'No description')
+    try:
+        if order == 'recent':
+            return (int(cursor),)
 
-    # make sure there is a cover
-    cover = resp.get("covers", ['No image available'])
-    cover = cover[0]
+        readers, book_key = cursor.split(":", 1)
+        return (int(readers), book_key)
 
-    # make sure there is a published date
-    published = resp.get("first_publish_date", 'No date available')
+    except ValueError:
+        return None
 
-    authors = []
 
-    for author in resp['authors']:
-        authorResp = requests.get(
-            f"https://openlibrary.org/{author['author']['key']}.json",
-            params={}
-        )
+@app.route('/users/<int:user_id>/<key>', methods=["GET"])
+async def users_book_details(user_id,key):
+    """ Show a book's details"""
+    
+    if not g.user or g.user.id != int(user_id):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-        authorResp = authorResp.json()
+    book = await load_book_page(key)
+    book["user_id"] = user_id
 
-        authors.append(authorResp['name'])
-        authors = list(set(authors ))
+    return render_cached(book_version(book), 'users/book.html', book=book)
 
-    # get reviews and user associated with book
-    reviews = (Review
-            .query
-            .filter(Review.book_key == key)
-            .order_by(Review.timestamp.desc())
-            .limit(100)
-            .all())
+@app.route('/users/<int:user_id>/<key>/readers', methods=["GET"])
+async def readers_book_details(user_id,key):
+    """ Show a book's details"""
     
+    if not g.user or g.user.id != int(user_id):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    book = {
-        "title": resp['title'],
-        "published": published,
-        "description": desc,
-        "authors" : authors,
-        "cover" : cover,
-        "key" : key,
-        "reviews" : reviews,
-        "user_id" : user_id
-    }
+    book = await load_book_page(key)
+    book["user_id"] = user_id
 
-    return render_template('users/book_readers.html', book=book)
+    return render_cached(book_version(book), 'users/book_readers.html', book=book)
 
 
 @app.route('/users/<int:user_id>/<book_key>/review', methods=["GET", "POST"])
@@ -306,6 +412,7 @@ def user_review_add(user_id,book_key):
         review = Review(review=form.review.data,book_key=book_key,user_id=g.user.id)
         db.session.add(review)
         db.session.commit()
+        save_book_quietly(book_key)
 
         return redirect(f"/users/{user_id}/{book_key}")
 
@@ -314,6 +421,7 @@ def user_review_add(user_id,book_key):
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
+@cache_control("no-store")
 def profile():
     """Update profile for current user."""
     #if invalid user
@@ -322,22 +430,28 @@ def profile():
         return redirect("/")
 
 
-    form = UserProfileForm(obj= g.user)
+    curr_user = g.user.load()
+
+    if not curr_user:
+        do_logout()
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = UserProfileForm(obj= curr_user)
 
 
     if form.validate_on_submit():
-        #check to see if valid user
-        password_to_check = form.password.data
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
-        if user:
-            g.user.first_name = form.first_name.data
-            g.user.last_name = form.last_name.data
-            g.user.username = form.username.data
-            g.user.email = form.email.data
+        #check the password of the logged in user (the form may be
+        #changing their username)
+        if curr_user.check_password(form.password.data):
+            curr_user.first_name = form.first_name.data
+            curr_user.last_name = form.last_name.data
+            curr_user.username = form.username.data
+            curr_user.email = form.email.data
             db.session.commit()
+            do_login(curr_user)
 
-            return redirect(f"/users/{g.user.id}")
+            return redirect(f"/users/{curr_user.id}")
         else:
             flash("Invalid credentials.", 'danger')
 
@@ -353,10 +467,12 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    curr_user = g.user.load()
     do_logout()
 
-    db.session.delete(g.user)
-    db.session.commit()
+    if curr_user:
+        db.session.delete(curr_user)
+        db.session.commit()
 
     return redirect("/signup")
 
@@ -371,19 +487,13 @@ def books_trending():
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    resp = requests.get(
-            "https://openlibrary.org/trending/now.json?limit=15",
-            params={}
-       )
-       
-    books = resp.json()['works']
-    for book in books:
-        book['author_name'] = book.get("author_name", ["No author listed"]) #default if no author
-        book['author_name'] = list(set(book['author_name'] )) #remove dupes
-        book['key'] = book['key'].replace("works/","")
-        book['key'] = "/books/book/" + book['key']
-
-    return render_template('books/index.html', books=books)
+    try:
+        books = get_trending()
+    except RequestException:
+        flash("Trending books are not available right now.", "danger")
+        books = []
+
+    return render_cached(books, 'books/index.html', books=books)
 
 @app.route('/books/search', methods=["GET"])
 def books_search():
@@ -393,96 +503,106 @@ def books_search():
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    search_term = request.args.get('q')
-    search_cat = request.args.get('category')
-
-    params = [('limit', '15'),('offset', '1')]
-
-    if search_term > 'subject':
-        p = ('subject',search_cat)
-    elif search_term > 'title':
-        p = ('title',search_cat)
-    else: 
-        p = ('author',search_cat)
-
-    params.append(('subject', search_cat))
-    resp = requests.get(
-        "https://openlibrary.org/search.json",
-        params = params
-
-    )
+    try:
+        books = search_books(request.args.get('q'), request.args.get('category'))
+    except RequestException:
+        flash("Search is not available right now.", "danger")
+        books = []
 
-    books = resp.json()['docs']
-    for book in books:
-        book['author_name'] = book.get("author_name", ["No author listed"]) #default if no author
-        book['author_name'] = list(set(book['author_name'] )) #remove dupes
-        book['key'] = book['key'].replace("works/","")
-        book['key'] = "/books/book/" + book['key']
-
-    return render_template('books/search.html', books=books)
+    return render_cached(books, 'books/search.html', books=books)
 
 
 @app.route('/books/book/<key>', methods=["GET"])
-def book_details(key):
+async def book_details(key):
     """ Show a book's details"""
     
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    resp = requests.get(
-            f"https://openlibrary.org/works/{key}.json",
-            params={}
-       )
-       
-    resp = resp.json()
+    book = await load_book_page(key)
 
-    # make sure there is a description
-    desc = resp.get("description", 'No description')
-  
-    if isinstance(desc, dict):
-        desc = desc.get("value",'No description')
+    return render_cached(book_version(book), 'books/book.html', book=book)
 
-    # make sure there is a cover
-    cover = resp.get("covers", ['No image available'])
-    cover = cover[0]
+@app.route('/books/book/<key>/reviews', methods=["GET"])
+def book_reviews(key):
+    """Show the page of a book's reviews after ?after=, as an HTML fragment
+    for the book pages to append."""
 
-    # make sure there is a published date
-    published = resp.get("first_publish_date", 'No date available')
+    if not g.user:
+        abort(401)
 
-    authors = []
+    reviews, next_reviews = reviews_page(key, request.args.get('after'))
+    book = {"key": key, "reviews": reviews, "next_reviews": next_reviews}
 
-    for author in resp['authors']:
-        authorResp = requests.get(
-            f"https://openlibrary.org/{author['author']['key']}.json",
-            params={}
-        )
+    return render_template('books/reviews.html', book=book)
 
-        authorResp = authorResp.json()
 
-        authors.append(authorResp['name'])
-        authors = list(set(authors ))
+async def load_book_page(key):
+    """Get the book dict for `key` with its first page of reviews.
 
-    # get reviews and user associated with book
-    reviews = (Review
-            .query
-            .filter(Review.book_key == key)
-            .order_by(Review.timestamp.desc())
-            .limit(100)
-            .all())
-    
+    The reviews query runs while Open Library is being called for the
+    work and its authors.
+    """
+
+    async def reviews():
+        return reviews_page(key)
+
+    book, (book_reviews, next_reviews) = await asyncio.gather(
+        make_book_async(key), reviews())
+
+    book["reviews"] = book_reviews
+    book["next_reviews"] = next_reviews
+
+    return book
+
+
+def book_version(book):
+    """What a book page shows, for its ETag."""
+
+    shown = {k: v for k, v in book.items() if k != "reviews"}
+    reviews = [(review.id, review.user.username) for review in book["reviews"]]
+
+    return shown, reviews
 
-    book = {
-        "title": resp['title'],
-        "published": published,
-        "description": desc,
-        "authors" : authors,
-        "cover" : cover,
-        "key" : key,
-        "reviews" : reviews
-    }
 
-    return render_template('books/book.html', book=book)
+def reviews_page(key, after=None):
+    """Get a page of reviews for book `key`, newest first.
+
+    `after` is the cursor of the previous page. Returns the reviews and
+    the cursor for the page after them (None on the last page).
+    """
+
+    page_size = app.config['REVIEWS_PAGE_SIZE']
+
+    # get one extra row to know whether there is a next page
+    reviews = Review.page(key, parse_reviews_cursor(after), page_size + 1)
+
+    if len(reviews) <= page_size:
+        return reviews, None
+
+    reviews = reviews[:page_size]
+    last = reviews[-1]
+
+    return reviews, f"{last.timestamp.isoformat()}_{last.id}"
+
+
+def parse_reviews_cursor(cursor):
+    """Turn an ?after= cursor for reviews back into (timestamp, id).
+
+    Anything malformed starts from the first page.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        timestamp, review_id = cursor.rsplit("_", 1)
+        return (datetime.fromisoformat(timestamp), int(review_id))
+
+    except ValueError:
+        return None
+
 
 @app.route('/books/book/<book_key>/review', methods=["GET", "POST"])
 def review_add(book_key):
@@ -501,6 +621,7 @@ def review_add(book_key):
         review = Review(review=form.review.data,book_key=book_key,user_id=g.user.id)
         db.session.add(review)
         db.session.commit()
+        save_book_quietly(book_key)
 
         return redirect(f"/books/book/{book_key}")
 
@@ -519,14 +640,56 @@ def like_add(book_key):
 
 
     
-    like = Like(book_key=book_key,user_id=g.user.id)
-    db.session.add(like)
+    added = Like.add(user_id=g.user.id, book_key=book_key)
     db.session.commit()
 
-    flash("Book has been added to your likes.", "success")
+    if added:
+        save_book_quietly(book_key)
+        flash("Book has been added to your likes.", "success")
+    else:
+        flash("Book is already in your likes.", "success")
+
     return redirect(f"/books/book/{book_key}")
 
 
+##############################################################################
+# Covers
+
+@app.route('/covers/<cover_id>-<size>.jpg')
+@cache_control(None)
+def cover_image(cover_id, size):
+    """Serve a book cover from our cover cache, fetching it from Open
+    Library the first time. Missing covers redirect to a placeholder."""
+
+    path = None
+    placeholder_policy = 'public, max-age=86400'
+
+    if cover_id.isdigit() and size in COVER_SIZES:
+        try:
+            path = get_cover(int(cover_id), size)
+        except RequestException:
+            app.logger.warning("Fetching cover %s-%s failed", cover_id, size)
+            # Open Library may be back on the next request
+            placeholder_policy = 'no-store'
+
+    if path is None:
+        # the cover may turn up later, so don't remember this for long
+        resp = redirect(static_url('images/no-cover.svg'))
+        resp.headers['Cache-Control'] = placeholder_policy
+        return resp
+
+    # a cover id always means the same image
+    if app.config['COVER_ACCEL_REDIRECT']:
+        resp = app.response_class(mimetype='image/jpeg')
+        resp.headers['X-Accel-Redirect'] = (
+            app.config['COVER_ACCEL_REDIRECT'] + os.path.basename(path))
+    else:
+        resp = send_file(path, mimetype='image/jpeg')
+
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -548,21 +711,3 @@ def homepage():
 
     else:
         return render_template('home-anon.html')
-
-
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
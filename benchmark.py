@@ -0,0 +1,339 @@
+"""Route benchmarks against a local Open Library stub.
+
+Starts openlibrary_stub, points the app at it and at a scratch database
+and caches, seeds users, likes and reviews, then requests each route from
+several threads and reports throughput, p50/p95/p99 latency, and the
+Open Library calls and SQL queries each request made on average,
+counting the background catalog refreshes the route's requests started.
+
+    python benchmark.py                          # writes benchmark-<commit>.json
+    python benchmark.py --latency 0.2 --likes-per-user 200
+    python benchmark.py --compare benchmark-abc1234.json benchmark-def5678.json
+
+Pass --database-url to run on Postgres; that database is emptied first.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from openlibrary_stub import OpenLibraryStub
+
+# name, method, URL; {user_id} is the requesting user and {book} and
+# {cover} cycle through --distinct-books books
+ROUTES = [
+    ("trending", "GET", "/books/trending"),
+    ("search", "GET", "/books/search?q=work+{book}&category=title"),
+    ("book", "GET", "/books/book/{book}"),
+    ("book reviews", "GET", "/books/book/{book}/reviews"),
+    ("user book", "GET", "/users/{user_id}/{book}"),
+    ("reader book", "GET", "/users/{user_id}/{book}/readers"),
+    ("likes", "GET", "/users/{user_id}/likes"),
+    ("readers", "GET", "/users/{user_id}/readers"),
+    ("readers recent", "GET", "/users/{user_id}/readers?order=recent"),
+    ("cover", "GET", "/covers/{cover}-S.jpg"),
+    ("home", "GET", "/"),
+    ("profile", "GET", "/users/profile"),
+    ("like", "POST", "/books/book/{book}/like"),
+]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted `values`."""
+
+    if not values:
+        return None
+
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def skewed_books(rng, books, count):
+    """`count` distinct book numbers out of 1..`books`, low numbers far
+    more likely, the way a few books get most of the likes."""
+
+    weights = [1 / n for n in range(1, books + 1)]
+    picked = set()
+
+    while len(picked) < min(count, books):
+        picked.update(rng.choices(range(1, books + 1), weights,
+                                  k=count - len(picked)))
+
+    return list(picked)
+
+
+def seed(args, db, User, Like, Review):
+    """Fill the scratch database and return the benchmark users' ids."""
+
+    rng = random.Random(args.seed)
+    db.drop_all()
+    db.create_all()
+
+    users = [User.signup(username=f"bench{i}", first_name="Bench",
+                         last_name=f"User {i}", email=f"bench{i}@example.com",
+                         password="password")
+             for i in range(args.users)]
+    db.session.commit()
+
+    for user in users:
+        for n in skewed_books(rng, args.books, args.likes_per_user):
+            db.session.add(Like(user_id=user.id, book_key=f"OL{n}W"))
+
+    for i in range(args.reviews):
+        n = skewed_books(rng, args.books, 1)[0]
+        db.session.add(Review(user_id=rng.choice(users).id,
+                              book_key=f"OL{n}W", review=f"Review {i}"))
+
+    db.session.commit()
+
+    return [user.id for user in users]
+
+
+class QueryCounter:
+    """Counts SQL statements run on an engine, across all threads."""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self.add)
+
+    def add(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def wait_for_refreshes(helpers, timeout=60):
+    """Wait for the background catalog refreshes requests have started,
+    so their upstream calls and queries count against the route that
+    started them and no other."""
+
+    deadline = time.monotonic() + timeout
+
+    while helpers._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def run_route(clients, route, args, stub, queries, helpers):
+    """Benchmark one route; returns its result dict."""
+
+    name, method, url = route
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def request(client, user_id, i):
+        nonlocal errors
+
+        n = i % args.distinct_books + 1
+        path = url.format(user_id=user_id, book=f"OL{n}W", cover=n)
+
+        start = time.perf_counter()
+        resp = client.open(path, method=method)
+        resp.get_data()
+        elapsed = time.perf_counter() - start
+
+        with lock:
+            latencies.append(elapsed)
+            if resp.status_code >= 400:
+                errors += 1
+
+    wait_for_refreshes(helpers)
+
+    # one request alone first, from cold caches for this route
+    upstream = sum(stub.calls.values())
+    start = time.perf_counter()
+    request(*clients[0], 0)
+    cold = time.perf_counter() - start
+    wait_for_refreshes(helpers)
+    cold_upstream = sum(stub.calls.values()) - upstream
+    latencies.clear()
+
+    upstream = sum(stub.calls.values())
+    sql = queries.count
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(len(clients)) as pool:
+        for i in range(args.requests):
+            pool.submit(request, *clients[i % len(clients)], i + 1)
+
+    wall = time.perf_counter() - start
+    wait_for_refreshes(helpers)
+    latencies.sort()
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / wall, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "cold_ms": round(cold * 1000, 2),
+        "cold_upstream": cold_upstream,
+        "upstream_per_request": round(
+            (sum(stub.calls.values()) - upstream) / len(latencies), 2),
+        "sql_per_request": round((queries.count - sql) / len(latencies), 2),
+    }
+
+
+def commit_id():
+    repo = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=repo,
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=repo, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return commit + ("-dirty" if dirty else "")
+
+
+def benchmark(args):
+    scratch = tempfile.mkdtemp(prefix="the-book-list-bench-")
+    stub = OpenLibraryStub(latency=args.latency,
+                           authors_per_work=args.authors_per_work,
+                           description_bytes=args.description_bytes).start()
+
+    # the app reads these when it is imported
+    os.environ["OPENLIBRARY_URL"] = stub.url
+    os.environ["OPENLIBRARY_COVERS_URL"] = stub.url
+    os.environ["DATABASE_URL"] = (
+        args.database_url or f"sqlite:///{scratch}/bench.sqlite3")
+    os.environ["BOOK_CACHE_PATH"] = os.path.join(scratch, "cache.sqlite3")
+    os.environ["COVER_CACHE_DIR"] = os.path.join(scratch, "covers")
+    os.environ.setdefault("BCRYPT_LOG_ROUNDS", "4")
+
+    from app import app
+    from models import db, User, Like, Review
+    import helpers
+
+    app.config["WTF_CSRF_ENABLED"] = False
+
+    with app.app_context():
+        user_ids = seed(args, db, User, Like, Review)
+        queries = QueryCounter(db.engine)
+
+    clients = []
+    for i in range(args.concurrency):
+        client = app.test_client()
+        client.post("/login", data={"username": f"bench{i % args.users}",
+                                    "password": "password"})
+        clients.append((client, user_ids[i % args.users]))
+
+    results = {}
+    for route in ROUTES:
+        if args.routes and not any(r in route[0] for r in args.routes):
+            continue
+
+        results[route[0]] = run_route(clients, route, args, stub, queries,
+                                      helpers)
+        print_row(route[0], results[route[0]])
+
+    stub.stop()
+
+    return {
+        "commit": commit_id(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {k: v for k, v in vars(args).items()
+                     if k not in ("compare", "output", "routes")},
+        "routes": results,
+    }
+
+
+HEADER = (f"{'route':<16}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'cold ms':>9}{'upstream':>10}{'sql':>7}{'errors':>8}")
+
+
+def print_row(name, result):
+    print(f"{name:<16}{result['throughput']:>9}{result['p50_ms']:>9}"
+          f"{result['p95_ms']:>9}{result['p99_ms']:>9}{result['cold_ms']:>9}"
+          f"{result['upstream_per_request']:>10}{result['sql_per_request']:>7}"
+          f"{result['errors']:>8}")
+
+
+def compare(old_path, new_path):
+    """Print how each route changed between two result files."""
+
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'route':<16}{'p50 ms':>20}{'p95 ms':>20}{'upstream':>16}{'sql':>16}")
+
+    def change(a, b):
+        if not a:
+            return f"{a}->{b}"
+        return f"{b} ({(b - a) / a:+.0%})"
+
+    for name, result in new["routes"].items():
+        before = old["routes"].get(name)
+        if before is None:
+            print(f"{name:<16}  (new)")
+            continue
+
+        print(f"{name:<16}"
+              f"{change(before['p50_ms'], result['p50_ms']):>20}"
+              f"{change(before['p95_ms'], result['p95_ms']):>20}"
+              f"{change(before['upstream_per_request'], result['upstream_per_request']):>16}"
+              f"{change(before['sql_per_request'], result['sql_per_request']):>16}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the app's routes against a local Open Library stub.")
+    parser.add_argument("--requests", type=int, default=50,
+                        help="requests per route (default 50)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="concurrent clients, each its own user (default 4)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds the stub waits per call (default 0.05)")
+    parser.add_argument("--authors-per-work", type=int, default=2)
+    parser.add_argument("--description-bytes", type=int, default=500)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--books", type=int, default=500,
+                        help="how many different books are liked (default 500)")
+    parser.add_argument("--likes-per-user", type=int, default=30)
+    parser.add_argument("--reviews", type=int, default=200)
+    parser.add_argument("--distinct-books", type=int, default=20,
+                        help="books the per-book routes cycle through (default 20)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url",
+                        help="database to run on (emptied!); default a scratch SQLite file")
+    parser.add_argument("--routes", nargs="*",
+                        help="only run routes whose name contains one of these")
+    parser.add_argument("--output", help="results file (default benchmark-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two results files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    args.concurrency = min(args.concurrency, args.users)
+
+    print(HEADER)
+    results = benchmark(args)
+
+    output = args.output or f"benchmark-{results['commit']}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"wrote {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
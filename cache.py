@@ -0,0 +1,694 @@
+"""Caches for data fetched from Open Library.
+
+Lookups go through two tiers: a small in-process LRU with a short TTL and a
+SQLite file on local disk that every worker on the host reads and writes.
+Values must be JSON-serializable, and callers should treat what they get
+back as read-only since the in-process tier hands out shared objects.
+
+A cache's contents can be written to a snapshot file and loaded into
+another cache, e.g. to warm a fresh worker or to run without Open Library.
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """In-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if absent or expired."""
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key, default=None):
+        """Return the value for `key` even if it has expired, as long as
+        it is still held."""
+
+        with self._lock:
+            entry = self._data.get(key)
+
+        return default if entry is None else entry[0]
+
+    def get_many(self, keys):
+        """Return a dict of the values found for `keys`."""
+
+        found = {}
+        for key in keys:
+            value = self.get(key, MISSING)
+            if value is not MISSING:
+                found[key] = value
+
+        return found
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`, evicting the least recently used."""
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set_many(self, entries, replace=True):
+        """Store (key, value, ttl) `entries`; with `replace` False, keys
+        already present are left alone."""
+
+        for key, value, ttl in entries:
+            if replace or key not in self._data:
+                self.set(key, value, ttl)
+
+    def items(self):
+        """(key, value, seconds left) for every live entry."""
+
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._data.items())
+
+        return [(key, value, expires - now)
+                for key, (value, expires) in entries if expires > now]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class DiskCache:
+    """Cache kept in a SQLite file so all workers on a host can share it.
+
+    Each thread (and each forked worker) opens its own connection. Errors
+    from SQLite are counted and treated as misses so a bad cache file never
+    takes a page down.
+    """
+
+    # Only bump an entry's access time when it is at least this stale, so
+    # hot keys don't turn every read into a write.
+    TOUCH_INTERVAL = 60
+
+    # Run the size check once every this many writes.
+    EVICT_EVERY = 100
+
+    def __init__(self, path, maxsize=50000, ttl=86400, stale_ttl=0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # expired entries are kept this much longer for get_stale
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        self._writes = 0
+        self._local = threading.local()
+
+        try:
+            self._connect().execute(
+                """CREATE TABLE IF NOT EXISTS cache (
+                       key TEXT PRIMARY KEY,
+                       value TEXT NOT NULL,
+                       expires REAL NOT NULL,
+                       accessed REAL NOT NULL
+                   )""")
+            self._connect().execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        except sqlite3.Error:
+            self.errors += 1
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def __len__(self):
+        try:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM cache").fetchone()[0]
+        except sqlite3.Error:
+            self.errors += 1
+            return 0
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if absent or expired."""
+
+        now = time.time()
+
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, expires, accessed FROM cache WHERE key = ?",
+                (key,)).fetchone()
+
+            if row is None or row[1] <= now:
+                self.misses += 1
+                return default
+
+            if now - row[2] > self.TOUCH_INTERVAL:
+                conn.execute(
+                    "UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+
+            value = json.loads(row[0])
+
+        except (sqlite3.Error, ValueError):
+            self.errors += 1
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def get_stale(self, key, default=None):
+        """Return the value for `key` even if it has expired, as long as
+        it expired less than stale_ttl seconds ago."""
+
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM cache WHERE key = ? AND expires > ?",
+                (key, time.time() - self.stale_ttl)).fetchone()
+
+            if row is None:
+                return default
+
+            return json.loads(row[0])
+
+        except (sqlite3.Error, ValueError):
+            self.errors += 1
+            return default
+
+    # SQLite allows this many parameters per statement in older builds
+    MAX_PARAMS = 500
+
+    def get_many(self, keys):
+        """Return a dict of the values found for `keys`, read with one
+        query per MAX_PARAMS keys."""
+
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        found = {}
+        touch = []
+
+        try:
+            conn = self._connect()
+
+            for i in range(0, len(keys), self.MAX_PARAMS):
+                chunk = keys[i:i + self.MAX_PARAMS]
+                rows = conn.execute(
+                    "SELECT key, value, expires, accessed FROM cache"
+                    f" WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+
+                for key, value, expires, accessed in rows:
+                    if expires > now:
+                        found[key] = json.loads(value)
+                        if now - accessed > self.TOUCH_INTERVAL:
+                            touch.append((now, key))
+
+            if touch:
+                conn.executemany(
+                    "UPDATE cache SET accessed = ? WHERE key = ?", touch)
+
+        except (sqlite3.Error, ValueError):
+            self.errors += 1
+            self.misses += len(keys)
+            return {}
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`; trims the file when it grows too big."""
+
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires, now))
+        except sqlite3.Error:
+            self.errors += 1
+            return
+
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def set_many(self, entries, replace=True):
+        """Store (key, value, ttl) `entries` in one transaction; with
+        `replace` False, keys already present are left alone."""
+
+        now = time.time()
+        rows = [(key, json.dumps(value),
+                 now + (self.ttl if ttl is None else ttl), now)
+                for key, value, ttl in entries]
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(f"{verb} INTO cache VALUES (?, ?, ?, ?)", rows)
+        except sqlite3.Error:
+            self.errors += 1
+            return
+
+        self.evict()
+
+    def items(self):
+        """(key, value, seconds left) for every live entry."""
+
+        now = time.time()
+
+        try:
+            rows = self._connect().execute(
+                "SELECT key, value, expires FROM cache WHERE expires > ?",
+                (now,)).fetchall()
+            return [(key, json.loads(value), expires - now)
+                    for key, value, expires in rows]
+        except (sqlite3.Error, ValueError):
+            self.errors += 1
+            return []
+
+    def delete(self, key):
+        try:
+            self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+        except sqlite3.Error:
+            self.errors += 1
+
+    def clear(self):
+        try:
+            self._connect().execute("DELETE FROM cache")
+        except sqlite3.Error:
+            self.errors += 1
+
+    def evict(self):
+        """Drop entries past their stale_ttl, then the least recently used
+        over maxsize."""
+
+        try:
+            conn = self._connect()
+            expired = conn.execute(
+                "DELETE FROM cache WHERE expires <= ?",
+                (time.time() - self.stale_ttl,)).rowcount
+            overflow = conn.execute(
+                """DELETE FROM cache WHERE key IN (
+                       SELECT key FROM cache ORDER BY accessed
+                       LIMIT max((SELECT COUNT(*) FROM cache) - ?, 0)
+                   )""", (self.maxsize,)).rowcount
+        except sqlite3.Error:
+            self.errors += 1
+            return
+
+        self.evictions += expired + overflow
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+
+class FileCache:
+    """Files in a directory, capped at `max_bytes` in total.
+
+    Reading a file bumps its mtime, and eviction removes the oldest
+    first, so it behaves as an LRU. Writes are atomic renames, so workers
+    can share the directory.
+    """
+
+    # Run the size check once every this many writes.
+    EVICT_EVERY = 50
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, name):
+        """Return the path of the cached file `name`, or None."""
+
+        path = os.path.join(self.directory, name)
+
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return path
+
+    def put(self, name, data):
+        """Store `data` as `name` and return its path."""
+
+        path = os.path.join(self.directory, name)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+        return path
+
+    def evict(self):
+        """Remove least recently used files until under max_bytes."""
+
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; callers arriving while
+    it runs wait for it and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.collapsed = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = {"done": threading.Event()}
+                self.calls += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            flight["done"].wait()
+            if "error" in flight:
+                raise flight["error"]
+            return flight["result"]
+
+        try:
+            flight["result"] = fn()
+            return flight["result"]
+
+        except BaseException as error:
+            flight["error"] = error
+            raise
+
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight["done"].set()
+
+    def stats(self):
+        return {"calls": self.calls, "collapsed": self.collapsed}
+
+
+class TieredCache:
+    """In-process LRU in front of an optional shared DiskCache.
+
+    Concurrent misses for the same key in a worker share one fetch.
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.flight = SingleFlight()
+
+    @classmethod
+    def from_env(cls):
+        """Build a cache configured from BOOK_CACHE_* environment variables.
+
+        Set BOOK_CACHE_PATH to an empty string to run without the disk tier.
+        """
+
+        local = LRUCache(
+            maxsize=int(os.environ.get("BOOK_CACHE_SIZE", 1024)),
+            ttl=int(os.environ.get("BOOK_CACHE_TTL", 300)),
+        )
+
+        path = os.environ.get(
+            "BOOK_CACHE_PATH",
+            os.path.join(tempfile.gettempdir(), "the-book-list-cache.sqlite3"))
+
+        shared = None
+        if path:
+            shared = DiskCache(
+                path,
+                maxsize=int(os.environ.get("BOOK_CACHE_DISK_SIZE", 50000)),
+                ttl=int(os.environ.get("BOOK_CACHE_DISK_TTL", 86400)),
+                stale_ttl=int(os.environ.get("BOOK_CACHE_STALE_TTL",
+                                             7 * 24 * 60 * 60)),
+            )
+
+        return cls(local, shared)
+
+    def get(self, key, default=None):
+        value = self.local.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(key, MISSING)
+            if value is not MISSING:
+                self.local.set(key, value)
+                return value
+
+        return default
+
+    def get_many(self, keys):
+        """Return a dict of the values found for `keys`, looking in the
+        shared tier only for those the local one doesn't have."""
+
+        found = self.local.get_many(keys)
+        missing = [key for key in keys if key not in found]
+
+        if missing and self.shared is not None:
+            shared = self.shared.get_many(missing)
+            for key, value in shared.items():
+                self.local.set(key, value)
+            found.update(shared)
+
+        return found
+
+    def set(self, key, value, ttl=None):
+        """Store in both tiers. The local copy never outlives its own TTL,
+        so refreshes written by other workers are picked up."""
+
+        local_ttl = self.local.ttl if ttl is None else min(ttl, self.local.ttl)
+        self.local.set(key, value, local_ttl)
+
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def get_stale(self, key, default=None):
+        """Return the freshest value held for `key`, even an expired one."""
+
+        value = self.local.get(key, MISSING)
+
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get_stale(key, MISSING)
+
+        if value is MISSING:
+            value = self.local.get_stale(key, MISSING)
+
+        return default if value is MISSING else value
+
+    def get_or_set(self, key, fetch, ttl=None, stale_on=()):
+        """Return the cached value for `key`, calling `fetch()` on a miss.
+
+        If `fetch()` raises one of the `stale_on` exceptions, an expired
+        value for `key` is returned instead when there is one.
+        """
+
+        value = self.get(key, MISSING)
+
+        if value is MISSING:
+            def fetch_and_set():
+                value = fetch()
+                self.set(key, value, ttl)
+                return value
+
+            try:
+                value = self.flight.do(key, fetch_and_set)
+            except stale_on:
+                value = self.get_stale(key, MISSING)
+                if value is MISSING:
+                    raise
+
+        return value
+
+    def set_many(self, entries, replace=True):
+        """Store (key, value, ttl) `entries`: in the shared tier when there
+        is one (workers pick them up from there), else in the local one."""
+
+        if self.shared is not None:
+            self.shared.set_many(entries, replace)
+        else:
+            self.local.set_many(entries, replace)
+
+    def items(self):
+        """(key, value, seconds left) for every entry of the shared tier,
+        or of the local one when there is no shared tier."""
+
+        if self.shared is not None:
+            return self.shared.items()
+
+        return self.local.items()
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        return {
+            "local": self.local.stats(),
+            "shared": self.shared.stats() if self.shared is not None else None,
+            "flight": self.flight.stats(),
+        }
+
+
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(cache, path, prefixes):
+    """Write the entries of `cache` whose keys start with one of
+    `prefixes` to the gzipped JSON lines file `path`. Returns how many."""
+
+    now = time.time()
+    count = 0
+
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps({"version": SNAPSHOT_VERSION, "created": now}) + "\n")
+
+        for key, value, ttl in cache.items():
+            if key.startswith(tuple(prefixes)):
+                f.write(json.dumps([key, value, now + ttl]) + "\n")
+                count += 1
+
+    return count
+
+
+def read_snapshot(cache, path, ttl=None):
+    """Load the snapshot file `path` into `cache`, without replacing what
+    it already has. Returns how many entries were loaded.
+
+    Entries keep the expiry they had; those that have since expired are
+    skipped. With `ttl`, every entry lives that long from now instead,
+    which suits snapshots kept as fixtures.
+    """
+
+    now = time.time()
+    entries = []
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"{path}: unknown snapshot version "
+                             f"{header.get('version')}")
+
+        for line in f:
+            key, value, expires = json.loads(line)
+            left = ttl if ttl is not None else expires - now
+            if left > 0:
+                entries.append((key, value, left))
+
+    cache.set_many(entries, replace=False)
+
+    return len(entries)
@@ -0,0 +1,95 @@
+"""Request-scoped batching and de-duplication of lookups.
+
+A page can ask for the same work or author many times: duplicate likes,
+authors shared by many works. Within a request, loader(name, batch) hands
+out one DataLoader per name, which fetches each key at most once however
+often it is asked for, and fetches all the keys asked for together in
+one batch. This works with or without the cross-request cache.
+
+The scope is a context variable, so threads working for a request (that
+run with a copy of its context) share its loaders. Outside a request
+every loader() call gets a fresh DataLoader.
+"""
+
+import threading
+from contextvars import ContextVar
+
+from flask import g
+
+_scope = ContextVar("dataloader_scope", default=None)
+
+
+class DataLoader:
+    """Memoizes `batch(keys)`, which returns the values for `keys` in order.
+
+    Failed batches raise to the caller and aren't remembered.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.loaded = {}
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def load_many(self, keys):
+        """The values for `keys`, in order, fetching those not loaded yet
+        in one batch without duplicates."""
+
+        keys = list(keys)
+
+        with self._lock:
+            missing = [key for key in dict.fromkeys(keys)
+                       if key not in self.loaded]
+
+        if missing:
+            values = self.batch(missing)
+
+            with self._lock:
+                self.loaded.update(zip(missing, values))
+                self.batches += 1
+
+        return [self.loaded[key] for key in keys]
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+
+def loader(name, batch):
+    """The current request's DataLoader for `name`, made with `batch` the
+    first time it is asked for."""
+
+    scope = _scope.get()
+
+    if scope is None:
+        return DataLoader(batch)
+
+    # setdefault is atomic, so threads of one request agree on a loader
+    return scope.setdefault(name, DataLoader(batch))
+
+
+def start_scope():
+    """Start a new set of loaders for the current context. Returns a token
+    for end_scope."""
+
+    return _scope.set({})
+
+
+def end_scope(token):
+    """Go back to the loaders (or none) from before start_scope."""
+
+    _scope.reset(token)
+
+
+def init_loaders(app):
+    """Give each request its own loaders, dropped when it ends (for a
+    streamed page, once it has been sent)."""
+
+    @app.before_request
+    def start_loaders():
+        g.loader_scope = start_scope()
+
+    @app.teardown_request
+    def end_loaders(error):
+        token = g.pop("loader_scope", None)
+        if token is not None:
+            end_scope(token)
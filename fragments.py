@@ -0,0 +1,90 @@
+"""Rendered HTML fragments for book cards.
+
+The list pages (likes, readers, trending and search) show the same cards
+for the same books over and over. Each card is rendered once per worker
+and kept in an LRU keyed by book and variant, together with a version of
+the data it shows; a card whose data has changed is rendered again.
+"""
+
+import hashlib
+import itertools
+import os
+
+from flask import render_template
+from markupsafe import Markup
+
+from cache import LRUCache
+
+# the fields each card variant shows, which make up its version
+CARD_FIELDS = {
+    "likes": ("key", "title", "cover", "authors", "published", "degraded"),
+    "readers": ("key", "title", "cover", "authors", "published", "readers",
+                "degraded"),
+    "search": ("key", "title", "cover_i", "author_name", "first_publish_year"),
+}
+
+CARDS_PER_ROW = 3
+
+fragments = LRUCache(
+    maxsize=int(os.environ.get("FRAGMENT_CACHE_SIZE", 4096)),
+    ttl=int(os.environ.get("FRAGMENT_CACHE_TTL", 24 * 60 * 60)))
+
+
+def book_id(key):
+    """The work key (OL...W) in any of the forms the list pages use."""
+
+    return key.rsplit("/", 1)[-1]
+
+
+def card_version(book, variant):
+    """Short hash of what the `variant` card shows for `book`."""
+
+    shown = tuple(book.get(field) for field in CARD_FIELDS[variant])
+    return hashlib.sha1(repr(shown).encode()).hexdigest()[:16]
+
+
+def render_card(book, variant):
+    """The HTML for one book card, from the fragment cache when current."""
+
+    cache_key = f"card:{variant}:{book_id(book['key'])}"
+    version = card_version(book, variant)
+
+    entry = fragments.get(cache_key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    html = render_template("books/card.html", book=book, variant=variant)
+    fragments.set(cache_key, (version, html))
+
+    return html
+
+
+def card_rows(books, variant):
+    """The cards for `books`, a row of markup at a time. `books` can be a
+    generator; each row is rendered as soon as its books have come out of
+    it, so a streamed page can send it before the rest are ready."""
+
+    books = iter(books)
+
+    while row := list(itertools.islice(books, CARDS_PER_ROW)):
+        cards = [render_card(book, variant) for book in row]
+        yield Markup('<div class="row card-deck">\n%s\n</div>' % "\n".join(cards))
+
+
+def card_deck(books, variant):
+    """All the cards for `books`, in rows, as markup for a list page."""
+
+    return Markup("\n".join(card_rows(books, variant)))
+
+
+def invalidate_cards(key):
+    """Drop every cached card for the work `key` in this worker. Other
+    workers notice the new data through the card's version."""
+
+    for variant in CARD_FIELDS:
+        fragments.delete(f"card:{variant}:{book_id(key)}")
+
+
+def init_fragments(app):
+    app.jinja_env.globals["card_deck"] = card_deck
+    app.jinja_env.globals["card_rows"] = card_rows
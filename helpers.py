@@ -1,52 +1,825 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
 import requests
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from api_helpers import client
+from cache import (TieredCache, FileCache, SingleFlight, write_snapshot,
+                   read_snapshot)
+from dataloader import loader
+from fragments import invalidate_cards
+from models import db, Book, Author, BookAuthor
+
+# works rarely change upstream and author names almost never do, so keep
+# them a good while; authors without a name are checked again daily
+WORK_TTL = 24 * 60 * 60
+AUTHOR_TTL = int(os.environ.get("AUTHOR_TTL", 30 * 24 * 60 * 60))
+NO_AUTHOR_TTL = 24 * 60 * 60
+
+# how old a book in the local catalog may get before it is refreshed
+BOOK_MAX_AGE = timedelta(
+    seconds=int(os.environ.get("BOOK_MAX_AGE", 7 * 24 * 60 * 60)))
+
+# keep the last good trending list this long, so it can still be served
+# through a long Open Library outage
+TRENDING_TTL = 30 * 24 * 60 * 60
+TRENDING_REFRESH = int(os.environ.get("TRENDING_REFRESH", 300))
+SEARCH_TTL = int(os.environ.get("SEARCH_TTL", 60 * 60))
+SEARCH_CATEGORIES = ("title", "subject", "author")
+
+# what goes into cache snapshots: everything fetched from Open Library
+SNAPSHOT_PREFIXES = ("work:", "author_name:", "trending", "search:", "card:")
+
+log = logging.getLogger(__name__)
+
+cache = TieredCache.from_env()
+
+COVER_SIZES = ("S", "M", "L")
+covers = FileCache(
+    os.environ.get("COVER_CACHE_DIR",
+                   os.path.join(tempfile.gettempdir(), "the-book-list-covers")),
+    max_bytes=int(os.environ.get("COVER_CACHE_BYTES", 512 * 1024 * 1024)))
+cover_flight = SingleFlight()
+
+# threads shared by every request for upstream fan-out, and how many of
+# them a single request may hold at once
+fetch_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("FETCH_THREADS", 32)),
+    thread_name_prefix="openlibrary")
+AUTHOR_CONCURRENCY = int(os.environ.get("AUTHOR_CONCURRENCY", 8))
+
+# background refreshes of the local catalog get threads of their own, so
+# a slow Open Library can't tie up the ones requests are waiting on (the
+# name makes bounded_map run inline on them)
+refresh_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("REFRESH_THREADS", 4)),
+    thread_name_prefix="openlibrary-refresh")
+
+# how many work keys to resolve per search.json call on list pages
+SEARCH_BATCH = int(os.environ.get("SEARCH_BATCH", 50))
+CARD_FIELDS = "key,title,cover_i,first_publish_year,author_name"
+
+# how many books not in the catalog a streamed list page fetches at a time
+STREAM_CHUNK = int(os.environ.get("STREAM_CHUNK", 12))
+
+
+def bounded_map(fn, items, limit):
+    """Like map(fn, items) run on fetch_pool, keeping at most `limit` calls
+    in flight. Results come back in the order of `items`."""
+
+    items = list(items)
+
+    # already on a pool thread (a fan-out inside a fan-out): run inline,
+    # since waiting on the pool from inside it can deadlock when it's busy
+    on_pool = threading.current_thread().name.startswith("openlibrary")
+
+    if len(items) <= 1 or on_pool:
+        return [fn(item) for item in items]
+
+    results = [None] * len(items)
+    todo = iter(enumerate(items))
+    pending = {}
+
+    def submit():
+        nxt = next(todo, None)
+        if nxt is not None:
+            # carry the request's context (and its timings) to the thread
+            ctx = contextvars.copy_context()
+            pending[fetch_pool.submit(ctx.run, fn, nxt[1])] = nxt[0]
+
+    for _ in range(limit):
+        submit()
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[pending.pop(future)] = future.result()
+            submit()
+
+    return results
+
+
+def bounded_imap(fn, items, limit):
+    """Like bounded_map, but returns an iterator that yields each result as
+    soon as it and those before it are done. The first `limit` calls start
+    straight away; the rest as results are taken."""
+
+    items = list(items)
+    on_pool = threading.current_thread().name.startswith("openlibrary")
+
+    if len(items) <= 1 or on_pool:
+        return map(fn, items)
+
+    todo = iter(items)
+    pending = deque()
+
+    def submit():
+        for item in itertools.islice(todo, 1):
+            ctx = contextvars.copy_context()
+            pending.append(fetch_pool.submit(ctx.run, fn, item))
+
+    for _ in range(limit):
+        submit()
+
+    def results():
+        try:
+            while pending:
+                result = pending.popleft().result()
+                submit()
+                yield result
+        finally:
+            # nobody wants the rest (the browser went away, say)
+            for future in pending:
+                future.cancel()
+
+    return results()
+
+
+def get_work(key, stale=True):
+    """Get the Open Library work record for `key` (e.g. OL45804W).
+
+    If Open Library can't be reached, an expired copy from the cache will
+    do unless `stale` is false.
+    """
+
+    return cache.get_or_set(
+        f"work:{key}", lambda: client.work(key), ttl=WORK_TTL,
+        stale_on=requests.RequestException if stale else ())
+
+
+def fetch_author_name(author_key):
+    """Get the name of `author_key` (/authors/...) from Open Library, or
+    None if there is no such author or the record has no name."""
+
+    try:
+        author = client.author(author_key)
+    except requests.HTTPError as error:
+        if error.response is not None and error.response.status_code == 404:
+            return None
+        raise
+
+    return author.get("name") or author.get("personal_name") or None
+
+
+def cache_author_name(author_key):
+    """fetch_author_name, remembering the answer (even None) for all
+    workers. Concurrent calls for one author share a fetch."""
+
+    def fetch():
+        name = fetch_author_name(author_key)
+        # "" marks an author known to have no name
+        cache.set(f"author_name:{author_key}", name or "",
+                  ttl=AUTHOR_TTL if name else NO_AUTHOR_TTL)
+        return name
+
+    try:
+        return cache.flight.do(f"author_name:{author_key}", fetch)
+    except requests.RequestException:
+        name = cache.get_stale(f"author_name:{author_key}")
+        if name is None:
+            raise
+        return name or None
+
+
+def load_author_names(author_keys):
+    """Names for `author_keys`, in order, None for those without one.
+
+    All cached names are read at once; the rest are fetched concurrently.
+    """
+
+    cached = cache.get_many([f"author_name:{key}" for key in author_keys])
+    names = {key: cached[f"author_name:{key}"] or None
+             for key in author_keys if f"author_name:{key}" in cached}
+
+    missing = [key for key in author_keys if key not in names]
+    names.update(zip(missing, bounded_map(cache_author_name, missing,
+                                          AUTHOR_CONCURRENCY)))
+
+    return [names[key] for key in author_keys]
+
+
+def work_loader():
+    """This request's loader for work records."""
+
+    return loader("works", lambda keys: bounded_map(
+        get_work, keys, AUTHOR_CONCURRENCY))
+
+
+def author_loader():
+    """This request's loader for author names."""
+
+    return loader("author_names", load_author_names)
 
-def make_books_from_likes(likes):
-    books = []
-     
-    for like in likes:
-        resp = requests.get(
-            f"https://openlibrary.org/works/{like.book_key}.json",
-            params={}
-        )
-        resp = resp.json()
 
-        # make sure there is a description
-        desc = resp.get("description", 'No description')
-    
-        if isinstance(desc, dict):
-            desc = desc.get("value",'No description')
+def get_authors(author_keys):
+    """Get (key, name) pairs for `author_keys`.
 
-        # make sure there is a cover
-        cover = resp.get("covers", ['No image available'])
-        cover = cover[0]
+    Keeps the order the work lists them in and drops duplicates and
+    authors without a name.
+    """
 
-        # make sure there is a published date
-        published = resp.get("first_publish_date", 'No date available')
+    keys = list(dict.fromkeys(author_keys))
+    names = author_loader().load_many(keys)
 
-        authors = []
+    return [(key, name) for key, name in zip(keys, names) if name]
 
-        for author in resp['authors']:
-            authorResp = requests.get(
-                f"https://openlibrary.org/{author['author']['key']}.json",
-                params={}
-            )
 
-            authorResp = authorResp.json()
+def get_author_names(author_keys):
+    """Get author names for `author_keys`, in order and without duplicates."""
 
-            authors.append(authorResp['name'])
-            authors = list(set(authors ))
-        
+    return list(dict.fromkeys(name for _, name in get_authors(author_keys)))
 
+
+def work_author_keys(work):
+    return [author['author']['key'] for author in work.get('authors', [])]
+
+
+def parse_work(key, work):
+    """Pull what the book pages show (except authors) out of a work record."""
+
+    # make sure there is a description
+    desc = work.get("description", 'No description')
+
+    if isinstance(desc, dict):
+        desc = desc.get("value",'No description')
+
+    # make sure there is a cover
+    cover = work.get("covers", ['No image available'])
+    cover = cover[0]
+
+    # make sure there is a published date
+    published = work.get("first_publish_date", 'No date available')
+
+    return {
+        "title": work['title'],
+        "published": published,
+        "description": desc,
+        "cover" : cover,
+        "key" : key
+    }
+
+
+def fetch_books(keys):
+    """Make the book dicts the templates use for work `keys` from Open
+    Library: the works in one batch, then the authors of all of them in
+    another, each fetched once."""
+
+    works = work_loader().load_many(keys)
+    author_keys = [work_author_keys(work) for work in works]
+
+    try:
+        author_loader().load_many(
+            author_key for keys in author_keys for author_key in keys)
+        degraded = False
+    except requests.RequestException:
+        # Open Library is down or out of time: show the books without
+        # their authors rather than not at all
+        degraded = True
+
+    books = []
+    for key, work, authors in zip(keys, works, author_keys):
+        book = parse_work(key, work)
+        book["authors"] = [] if degraded else get_author_names(authors)
+        if degraded:
+            book["degraded"] = True
+        books.append(book)
+
+    return books
+
+
+def degraded_book(key):
+    """The book dict for `key` when Open Library can't be reached in
+    time: from the work however long ago it was cached, without authors,
+    or just a placeholder. Never calls Open Library."""
+
+    work = cache.get_stale(f"work:{key}")
+
+    if work is not None:
+        book = parse_work(key, work)
+    else:
         book = {
-            "title": resp['title'],
-            "published": published,
-            "description": desc,
-            "authors" : authors,
-            "cover" : cover,
-            "key" : like.book_key
+            "title": "Title unavailable",
+            "published": 'No date available',
+            "description": 'No description',
+            "cover": 'No image available',
+            "key": key,
         }
 
-        books.append(book)
+    book["authors"] = []
+    book["degraded"] = True
+
+    return book
+
+
+async def run_in_pool(fn, *args):
+    """Run blocking `fn(*args)` on fetch_pool from a coroutine."""
+
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        fetch_pool, functools.partial(ctx.run, fn, *args))
+
+
+async def get_author_names_async(author_keys):
+    """Async get_author_names: looks all the names up in one go, off the
+    event loop. (Not on fetch_pool itself, so the names it has to fetch
+    can still fan out there.)"""
+
+    return await asyncio.to_thread(get_author_names, author_keys)
+
+
+async def fetch_book_async(key):
+    """Make the book dict the templates use for work `key` from Open
+    Library: the work, then all its authors at once, without holding up
+    the event loop."""
+
+    try:
+        work = await run_in_pool(work_loader().load, key)
+    except requests.RequestException:
+        return degraded_book(key)
+
+    book = parse_work(key, work)
+
+    try:
+        book["authors"] = await get_author_names_async(work_author_keys(work))
+    except requests.RequestException:
+        book["authors"] = []
+        book["degraded"] = True
+
+    return book
+
+
+def book_from_row(book):
+    """Make the book dict the templates use from a local Book row."""
+
+    return {
+        "title": book.title,
+        "published": book.first_publish_date or 'No date available',
+        "description": book.description or 'No description',
+        "authors" : list(dict.fromkeys(book.author_names)),
+        "cover" : book.cover_id or 'No image available',
+        "key" : book.key
+    }
+
+
+def is_stale(book):
+    return book.fetched_at < datetime.utcnow() - BOOK_MAX_AGE
+
+
+def save_book(key):
+    """Fetch the work `key` and its authors and store them in the local
+    catalog, replacing what was there. Returns the Book."""
+
+    # an old copy would be stored as if it were new
+    work = get_work(key, stale=False)
+    fields = parse_work(key, work)
+    authors = get_authors(work_author_keys(work))
+
+    try:
+        book = store_book(key, work, fields, authors)
+    except IntegrityError:
+        # another thread stored this book or one of its authors first;
+        # going again updates their rows instead
+        db.session.rollback()
+        book = store_book(key, work, fields, authors)
+
+    invalidate_cards(key)
+
+    return book
+
+
+def store_book(key, work, fields, authors):
+    """Upsert the Book `key` and its authors and commit."""
+
+    now = datetime.utcnow()
+
+    book = db.session.get(Book, key) or Book(key=key)
+    book.title = fields["title"]
+    book.cover_id = fields["cover"] if isinstance(fields["cover"], int) else None
+    book.first_publish_date = work.get("first_publish_date")
+    book.description = fields["description"]
+    book.fetched_at = now
+
+    existing = {ba.author_key: ba for ba in book.book_authors}
+    book_authors = []
+
+    for position, (author_key, name) in enumerate(authors):
+        author = db.session.merge(
+            Author(key=author_key, name=name, fetched_at=now))
+        book_author = existing.get(author_key) or BookAuthor(author_key=author_key)
+        book_author.author = author
+        book_author.position = position
+        book_authors.append(book_author)
+
+    book.book_authors = book_authors
+
+    db.session.add(book)
+    db.session.commit()
+
+    return book
+
+
+def save_book_quietly(key):
+    """Write-through for likes and reviews: store the book, but never let
+    an Open Library hiccup fail the user's action."""
+
+    try:
+        save_book(key)
+    except requests.RequestException:
+        db.session.rollback()
+    except Exception:
+        # the user's action is already committed; a work record we can't
+        # parse or a lost race for its row mustn't turn it into an error
+        log.exception("Storing book %s failed", key)
+        db.session.rollback()
+
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_books(keys):
+    """Re-fetch the books `keys` into the local catalog in the background.
+
+    Keys already being refreshed are skipped. Needs an app context.
+    """
+
+    app = current_app._get_current_object()
+
+    def refresh(key):
+        try:
+            with app.app_context():
+                save_book(key)
+        except requests.RequestException as error:
+            app.logger.warning("Refreshing book %s failed: %s", key, error)
+        except Exception:
+            app.logger.exception("Refreshing book %s failed", key)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    for key in keys:
+        with _refreshing_lock:
+            if key in _refreshing:
+                continue
+            _refreshing.add(key)
+
+        refresh_pool.submit(refresh, key)
+
+
+def catalog_book(key):
+    """Get the book dict for `key` from the local catalog, or None if it
+    isn't stored. Stale books are refreshed in the background."""
+
+    book = (Book
+            .query
+            .options(joinedload(Book.book_authors)
+                     .joinedload(BookAuthor.author))
+            .filter(Book.key == key)
+            .first())
+
+    if book is None:
+        return None
+
+    if is_stale(book):
+        refresh_books([key])
+
+    return book_from_row(book)
+
+
+async def make_book_async(key):
+    """Make the book dict the templates use for the work `key`.
+
+    Uses the local catalog when the book is in it and Open Library
+    otherwise. The catalog lookup runs on the event loop (it is one
+    quick query); Open Library calls don't block it.
+    """
+
+    return catalog_book(key) or await fetch_book_async(key)
+
+
+def search_works(keys):
+    """Look up many work `keys` with a single search.json call.
+
+    Returns search docs limited to the fields a book card needs. Keys
+    Open Library doesn't return are simply absent.
+    """
+
+    query = " OR ".join(f'"/works/{key}"' for key in keys)
+    resp = client.search(
+        {"q": f"key:({query})", "fields": CARD_FIELDS, "limit": len(keys)})
+
+    return resp['docs']
+
+
+def make_card(doc):
+    """Make a book card dict (as used by the list pages) from a search doc."""
+
+    return {
+        "title": doc['title'],
+        "published": doc.get("first_publish_year", 'No date available'),
+        "authors": list(dict.fromkeys(doc.get("author_name", []))),
+        "cover": doc.get("cover_i", 'No image available'),
+        "key": doc['key'].replace("/works/", "")
+    }
+
+
+def make_cards(keys):
+    """Get book cards for work `keys`, keyed by work key.
+
+    Cached cards are used first, the rest are resolved SEARCH_BATCH at a
+    time through search.json, and only keys the search misses fall back to
+    fetching the work and its authors one by one. When Open Library can't
+    be reached, those get old or degraded cards instead.
+    """
+
+    keys = list(dict.fromkeys(keys))
+    cards = {}
+
+    for key in keys:
+        card = cache.get(f"card:{key}")
+        if card is not None:
+            cards[key] = card
+
+    missing = [key for key in keys if key not in cards]
+    wanted = set(missing)
+    batches = [missing[i:i + SEARCH_BATCH]
+               for i in range(0, len(missing), SEARCH_BATCH)]
+
+    def search_batch(batch):
+        try:
+            return search_works(batch)
+        except requests.RequestException:
+            return []
+
+    for docs in bounded_map(search_batch, batches, AUTHOR_CONCURRENCY):
+        for doc in docs:
+            card = make_card(doc)
+            if card["key"] not in wanted:
+                continue
+            wanted.discard(card["key"])
+            cards[card["key"]] = card
+            cache.set(f"card:{card['key']}", card, ttl=WORK_TTL)
+
+    missing = [key for key in keys if key not in cards]
+    try:
+        books = fetch_books(missing)
+    except requests.RequestException:
+        # Open Library is down or out of time: the last card we had,
+        # however old, or what degraded_book can do
+        books = [cache.get_stale(f"card:{key}") or degraded_book(key)
+                 for key in missing]
+
+    for book in books:
+        cards[book["key"]] = book
+
+    return cards
+
+
+def books_from_catalog(keys, rows):
+    """Make book dicts for work `keys`, in order, given the Book `rows`
+    already loaded for them (a dict of key to Book).
+
+    Books in the local catalog render straight from it. Books not stored
+    yet are fetched as cards for now and added to the catalog in the
+    background, as are stale ones.
+    """
+
+    keys = list(keys)
+
+    return list(iter_books(keys, rows, chunk=len(keys)))
+
+
+def iter_books(keys, rows, chunk=STREAM_CHUNK):
+    """Like books_from_catalog, but yields the books one by one: those in
+    the catalog straight away, the others as each `chunk` of them has been
+    fetched. The chunks are fetched concurrently, starting right away.
+    Needs an app context while it runs."""
+
+    keys = list(keys)
+    cards = {key: book_from_row(book) for key, book in rows.items()}
+
+    missing = [key for key in dict.fromkeys(keys) if key not in rows]
+    stale = [key for key, book in rows.items() if is_stale(book)]
+    fetched = bounded_imap(make_cards,
+                           [missing[i:i + chunk]
+                            for i in range(0, len(missing), chunk)],
+                           AUTHOR_CONCURRENCY)
+
+    for key in keys:
+        if key not in cards:
+            # missing is in page order, so the next chunk has `key` first
+            cards.update(next(fetched))
+        yield cards[key]
+
+    if missing or stale:
+        refresh_books(missing + stale)
+
+
+def catalog_rows(keys):
+    """The Books in the local catalog for work `keys`, by key, with their
+    authors, in one query."""
+
+    rows = (Book
+            .query
+            .options(joinedload(Book.book_authors)
+                     .joinedload(BookAuthor.author))
+            .filter(Book.key.in_(set(keys)))
+            .all())
+
+    return {book.key: book for book in rows}
+
+
+def likes_catalog_rows(likes):
+    """The Books of `likes` loaded with their `book` relationship, by key."""
+
+    return {like.book_key: like.book for like in likes if like.book is not None}
+
+
+def make_books(keys):
+    """Make book dicts for work `keys`, loading the catalog in one query."""
+
+    keys = list(keys)
+
+    return books_from_catalog(keys, catalog_rows(keys))
+
+
+def make_books_from_likes(likes):
+    """Make book dicts for `likes`, loaded with their `book` relationship."""
+
+    return books_from_catalog([like.book_key for like in likes],
+                              likes_catalog_rows(likes))
+
+
+def get_cover(cover_id, size):
+    """Get the path of cover `cover_id` in `size` on local disk, fetching
+    it from Open Library the first time. None if there is no such cover."""
+
+    name = f"{cover_id}-{size}.jpg"
+
+    path = covers.get(name)
+    if path is not None or cache.get(f"nocover:{name}"):
+        return path
+
+    def fetch():
+        try:
+            return covers.put(name, client.cover(cover_id, size))
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                cache.set(f"nocover:{name}", True, ttl=WORK_TTL)
+                return None
+            raise
+
+    return cover_flight.do(name, fetch)
+
+
+def search_key(term, category, limit, offset):
+    """Normalize a search so equivalent ones share a cache entry."""
+
+    term = " ".join((term or "").lower().split())
+    category = (category or "").lower()
+    if category not in SEARCH_CATEGORIES:
+        category = "title"
+
+    return term, category, int(limit), int(offset)
+
+
+def search_books(term, category, limit=15, offset=1):
+    """Search Open Library for books whose `category` (title, subject or
+    author) matches `term`, ready for the template.
+
+    Results are cached, and identical searches already in flight in this
+    worker wait for that call instead of making their own.
+    """
+
+    term, category, limit, offset = search_key(term, category, limit, offset)
+    if not term:
+        return []
+
+    def fetch():
+        params = [('limit', limit), ('offset', offset), (category, term),
+                  ('fields', CARD_FIELDS)]
+
+        books = client.search(params)['docs']
+        for book in books:
+            book['author_name'] = book.get("author_name", ["No author listed"]) #default if no author
+            book['author_name'] = list(dict.fromkeys(book['author_name'])) #remove dupes
+            book['key'] = book['key'].replace("/works/", "")
+            book['key'] = "/books/book/" + book['key']
+
+        return books
+
+    return cache.get_or_set(f"search:{category}:{limit}:{offset}:{term}",
+                            fetch, ttl=SEARCH_TTL,
+                            stale_on=requests.RequestException)
+
+
+def fetch_trending():
+    """Get the trending list from Open Library, ready for the template."""
+
+    books = client.trending(limit=15)['works']
+    for book in books:
+        book['author_name'] = book.get("author_name", ["No author listed"]) #default if no author
+        book['author_name'] = list(dict.fromkeys(book['author_name'])) #remove dupes
+        book['key'] = book['key'].replace("/works/", "")
+        book['key'] = "/books/book/" + book['key']
 
     return books
 
+
+# last good trending entry in this process; never expires, so the page
+# is served at once even when the cache has lost its copy
+_last_trending = None
+
+
+def refresh_trending(force=False):
+    """Fetch the trending list into the shared cache.
+
+    Unless `force` is set, does nothing when the cached copy is younger
+    than TRENDING_REFRESH, so only one worker per interval goes upstream.
+    Returns the cached entry.
+    """
+
+    global _last_trending
+
+    entry = cache.get("trending") or _last_trending
+
+    if force or entry is None or time.time() - entry["fetched_at"] >= TRENDING_REFRESH:
+        entry = {"books": fetch_trending(), "fetched_at": time.time()}
+        cache.set("trending", entry, ttl=TRENDING_TTL)
+
+    _last_trending = entry
+    return entry
+
+
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+
+def start_trending_refresher():
+    """Start the thread that keeps the trending list fresh, once per
+    worker process."""
+
+    global _refresher_pid
+
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+
+    def run():
+        while True:
+            try:
+                refresh_trending()
+            except Exception:
+                # keep serving the last good copy
+                log.exception("Refreshing trending books failed")
+            time.sleep(TRENDING_REFRESH)
+
+    threading.Thread(target=run, name="trending-refresher",
+                     daemon=True).start()
+
+
+def get_trending():
+    """Get the trending list without waiting on Open Library.
+
+    Serves the last good copy, from the cache or else from this process,
+    while the refresher thread keeps it fresh. Only when this worker has
+    never had one does it fetch inline (once for all the requests waiting
+    on it), and that can raise.
+    """
+
+    entry = cache.get("trending") or _last_trending
+    if entry is None:
+        entry = cache.flight.do("trending",
+                                lambda: refresh_trending(force=True))
+
+    start_trending_refresher()
+
+    return entry["books"]
+
+
+def export_cache(path):
+    """Write the Open Library data in the cache to the snapshot `path`.
+    Returns how many entries were written."""
+
+    return write_snapshot(cache, path, SNAPSHOT_PREFIXES)
+
+
+def import_cache(path, ttl=None):
+    """Load the snapshot `path` into the cache (see cache.read_snapshot).
+    Returns how many entries were loaded."""
+
+    return read_snapshot(cache, path, ttl)
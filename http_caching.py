@@ -0,0 +1,123 @@
+"""HTTP caching: per-route Cache-Control, ETags and fingerprinted statics."""
+
+import hashlib
+import os
+
+from flask import (current_app, g, make_response, render_template, request,
+                   session, url_for)
+
+# pages that browsers may keep but must revalidate (a cheap 304 when
+# they have an ETag); they show the user's name, so never shared caches
+DEFAULT_POLICY = "private, no-cache"
+
+# fingerprinted static files never change at a given URL
+STATIC_POLICY = "public, max-age=31536000, immutable"
+UNVERSIONED_STATIC_POLICY = "public, max-age=3600"
+
+_fingerprints = {}
+
+
+def cache_control(policy):
+    """Set the Cache-Control header for a view's responses. With None the
+    view sets the header itself."""
+
+    def decorate(view):
+        view.cache_control = policy
+        return view
+
+    return decorate
+
+
+def fingerprint(path):
+    """Short content hash of the file or directory tree at `path`."""
+
+    if path not in _fingerprints:
+        digest = hashlib.sha1()
+
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    with open(os.path.join(root, name), "rb") as f:
+                        digest.update(name.encode())
+                        digest.update(f.read())
+        else:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+
+        _fingerprints[path] = digest.hexdigest()[:12]
+
+    return _fingerprints[path]
+
+
+def static_url(filename):
+    """URL for a static file, versioned by its contents so it can be
+    cached for good."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    return url_for("static", filename=filename, v=fingerprint(path))
+
+
+def cover_url(cover, size="S"):
+    """URL for a book cover served through our cover cache, or the
+    placeholder when the book has no cover."""
+
+    if isinstance(cover, int):
+        return f"/covers/{cover}-{size}.jpg"
+
+    return static_url("images/no-cover.svg")
+
+
+def render_cached(version, template, **context):
+    """Render `template`, or answer 304 Not Modified when the browser's
+    copy is current.
+
+    `version` is anything whose repr() changes whenever the page's data
+    does. The weak ETag also covers who is looking (the nav shows their
+    name), the templates and the static files whose versioned URLs the
+    page links to, so a deploy invalidates old copies.
+    """
+
+    # flashed messages show once, so such pages must not be reused
+    if session.get("_flashes"):
+        return render_template(template, **context)
+
+    user = (g.user.id, g.user.username) if g.user else None
+    templates = fingerprint(os.path.join(current_app.root_path,
+                                         current_app.template_folder))
+    statics = fingerprint(current_app.static_folder)
+    etag = hashlib.sha1(
+        repr((template, templates, statics, user, version)).encode()).hexdigest()
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render_template(template, **context))
+
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def init_http_caching(app):
+    """Set Cache-Control on every response from the view's policy."""
+
+    app.jinja_env.globals["static_url"] = static_url
+    app.jinja_env.globals["cover_url"] = cover_url
+
+    @app.after_request
+    def add_cache_headers(response):
+        if request.endpoint == "static":
+            if request.args.get("v"):
+                response.headers["Cache-Control"] = STATIC_POLICY
+            else:
+                response.headers["Cache-Control"] = UNVERSIONED_STATIC_POLICY
+
+        else:
+            view = app.view_functions.get(request.endpoint)
+            policy = getattr(view, "cache_control", DEFAULT_POLICY)
+
+            # views marked cache_control(None) set their own
+            if policy is not None:
+                response.headers["Cache-Control"] = policy
+
+        return response
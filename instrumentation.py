@@ -0,0 +1,340 @@
+"""Request instrumentation.
+
+Every request gets a RequestTimings that the SQLAlchemy engine events and
+the Open Library client add to, including from fetch_pool threads working
+for the request (helpers copies the context into them). When the request
+finishes, its totals go into per-route metrics, served in the Prometheus
+text format at /metrics, and optionally into a Server-Timing header.
+
+Metrics are kept per worker process.
+"""
+
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the request duration histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request ran more SQL queries than SQL_QUERY_BUDGET allows."""
+
+
+class RequestTimings:
+    """What one request spent on SQL and on Open Library."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_sql(self, seconds):
+        with self._lock:
+            self.sql_queries += 1
+            self.sql_seconds += seconds
+
+    def add_upstream(self, seconds):
+        with self._lock:
+            self.upstream_calls += 1
+            self.upstream_seconds += seconds
+
+
+current_timings = ContextVar("current_timings", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count SQL statements run within the current app context."""
+
+    if has_app_context():
+        g.sql_queries = g.get("sql_queries", 0) + 1
+
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    """Add a finished SQL statement to the current request's timings."""
+
+    started = conn.info["query_start"].pop()
+    timings = current_timings.get()
+
+    if timings is not None:
+        timings.add_sql(time.perf_counter() - started)
+
+
+@event.listens_for(Engine, "handle_error")
+def drop_query_start(context):
+    """Forget the start time of a statement that failed."""
+
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def record_upstream(seconds):
+    """Add an Open Library call to the current request's timings."""
+
+    timings = current_timings.get()
+
+    if timings is not None:
+        timings.add_upstream(seconds)
+
+
+def init_query_budget(app):
+    """When testing with SQL_QUERY_BUDGET set, fail any request that runs
+    more queries than that, so N+1 regressions break the tests.
+
+    Call this before registering other before_request hooks so their
+    queries are counted too.
+    """
+
+    @app.before_request
+    def reset_query_count():
+        # tests often share one app context across requests
+        g.sql_queries = 0
+
+    @app.after_request
+    def check_query_budget(response):
+        budget = app.config.get("SQL_QUERY_BUDGET")
+        queries = g.get("sql_queries", 0)
+
+        if app.testing and budget is not None and queries > budget:
+            raise QueryBudgetExceeded(
+                f"{request.method} {request.path} ran {queries} SQL queries;"
+                f" the budget is {budget}")
+
+        return response
+
+
+class Metrics:
+    """Per-route request counters and duration histograms."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.routes = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, method, status, seconds, timings):
+        with self._lock:
+            stat = self.routes.get(route)
+            if stat is None:
+                stat = self.routes[route] = {
+                    "count": 0, "seconds": 0.0,
+                    "buckets": [0] * len(self.buckets),
+                    "sql_queries": 0, "sql_seconds": 0.0,
+                    "upstream_calls": 0, "upstream_seconds": 0.0,
+                }
+
+            stat["count"] += 1
+            stat["seconds"] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stat["buckets"][i] += 1
+
+            stat["sql_queries"] += timings.sql_queries
+            stat["sql_seconds"] += timings.sql_seconds
+            stat["upstream_calls"] += timings.upstream_calls
+            stat["upstream_seconds"] += timings.upstream_seconds
+
+            key = (route, method, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def lines(self):
+        """The metrics in the Prometheus text format."""
+
+        with self._lock:
+            routes = {route: dict(stat, buckets=list(stat["buckets"]))
+                      for route, stat in self.routes.items()}
+            statuses = dict(self.statuses)
+
+        yield "# HELP booklist_requests_total Requests handled."
+        yield "# TYPE booklist_requests_total counter"
+        for (route, method, status), count in sorted(statuses.items()):
+            yield (f'booklist_requests_total{{route="{route}",method="{method}",'
+                   f'status="{status}"}} {count}')
+
+        yield "# HELP booklist_request_duration_seconds Time to handle a request."
+        yield "# TYPE booklist_request_duration_seconds histogram"
+        for route, stat in sorted(routes.items()):
+            for bound, count in zip(self.buckets, stat["buckets"]):
+                yield (f'booklist_request_duration_seconds_bucket{{route="{route}",'
+                       f'le="{bound}"}} {count}')
+            yield (f'booklist_request_duration_seconds_bucket{{route="{route}",'
+                   f'le="+Inf"}} {stat["count"]}')
+            yield (f'booklist_request_duration_seconds_sum{{route="{route}"}}'
+                   f' {stat["seconds"]:.6f}')
+            yield (f'booklist_request_duration_seconds_count{{route="{route}"}}'
+                   f' {stat["count"]}')
+
+        for field, help in (
+                ("sql_queries", "SQL statements run by requests."),
+                ("sql_seconds", "Time requests spent in SQL."),
+                ("upstream_calls", "Open Library calls made for requests."),
+                ("upstream_seconds",
+                 "Time spent in Open Library calls made for requests.")):
+            yield f"# HELP booklist_request_{field}_total {help}"
+            yield f"# TYPE booklist_request_{field}_total counter"
+            for route, stat in sorted(routes.items()):
+                yield f'booklist_request_{field}_total{{route="{route}"}} {stat[field]}'
+
+
+metrics = Metrics()
+
+
+def openlibrary_lines(stats):
+    """Metrics lines for OpenLibraryClient.stats."""
+
+    for field, help in (("calls", "Open Library calls."),
+                        ("errors", "Open Library calls that failed."),
+                        ("seconds", "Time spent in Open Library calls.")):
+        yield f"# HELP booklist_openlibrary_{field}_total {help}"
+        yield f"# TYPE booklist_openlibrary_{field}_total counter"
+        for endpoint, stat in sorted(stats.items()):
+            yield (f'booklist_openlibrary_{field}_total{{endpoint="{endpoint}"}}'
+                   f' {stat[field]}')
+
+
+def breaker_lines(breakers):
+    """Metrics lines for OpenLibraryClient.breakers."""
+
+    breakers = sorted(breakers.items())
+
+    yield ("# HELP booklist_openlibrary_circuit_state Circuit breaker state"
+           " per endpoint: 1 for the state it is in.")
+    yield "# TYPE booklist_openlibrary_circuit_state gauge"
+    for endpoint, breaker in breakers:
+        for state in (breaker.CLOSED, breaker.OPEN, breaker.HALF_OPEN):
+            yield (f'booklist_openlibrary_circuit_state{{endpoint="{endpoint}",'
+                   f'state="{state}"}} {int(breaker.state == state)}')
+
+    for field, help in (("trips", "Times the circuit opened."),
+                        ("rejected", "Calls refused while the circuit was open.")):
+        yield f"# HELP booklist_openlibrary_circuit_{field}_total {help}"
+        yield f"# TYPE booklist_openlibrary_circuit_{field}_total counter"
+        for endpoint, breaker in breakers:
+            yield (f'booklist_openlibrary_circuit_{field}_total'
+                   f'{{endpoint="{endpoint}"}} {getattr(breaker, field)}')
+
+
+def cache_lines(caches, flights):
+    """Metrics lines for caches (objects with stats() giving hits, misses
+    and evictions) and SingleFlights, each in a dict by name."""
+
+    stats = {name: c.stats() for name, c in caches.items() if c is not None}
+
+    for field in ("hits", "misses", "evictions"):
+        yield f"# HELP booklist_cache_{field}_total Cache {field}."
+        yield f"# TYPE booklist_cache_{field}_total counter"
+        for name, stat in sorted(stats.items()):
+            yield f'booklist_cache_{field}_total{{cache="{name}"}} {stat[field]}'
+
+    yield "# HELP booklist_cache_hit_ratio Share of lookups that were hits."
+    yield "# TYPE booklist_cache_hit_ratio gauge"
+    for name, stat in sorted(stats.items()):
+        lookups = stat["hits"] + stat["misses"]
+        ratio = stat["hits"] / lookups if lookups else 0
+        yield f'booklist_cache_hit_ratio{{cache="{name}"}} {ratio:.4f}'
+
+    yield ("# HELP booklist_cache_collapsed_total Concurrent misses that"
+           " waited for another caller's fetch.")
+    yield "# TYPE booklist_cache_collapsed_total counter"
+    for name, flight in sorted(flights.items()):
+        yield f'booklist_cache_collapsed_total{{cache="{name}"}} {flight.collapsed}'
+
+
+def password_lines(stats):
+    """Metrics lines for passwords.stats."""
+
+    yield "# HELP booklist_password_hashes_total Password hashes and checks."
+    yield "# TYPE booklist_password_hashes_total counter"
+    yield f'booklist_password_hashes_total{{kind="hash"}} {stats["hashes"]}'
+    yield f'booklist_password_hashes_total{{kind="check"}} {stats["checks"]}'
+
+    yield ("# HELP booklist_password_queue_seconds_total Time spent waiting"
+           " for the bcrypt pool.")
+    yield "# TYPE booklist_password_queue_seconds_total counter"
+    yield f'booklist_password_queue_seconds_total {stats["queue_seconds"]:.6f}'
+
+    yield ("# HELP booklist_password_queue_seconds_max Longest wait for the"
+           " bcrypt pool.")
+    yield "# TYPE booklist_password_queue_seconds_max gauge"
+    yield f'booklist_password_queue_seconds_max {stats["max_queue_seconds"]:.6f}'
+
+
+def server_timing(timings, seconds):
+    """A Server-Timing header value for one request."""
+
+    return ", ".join((
+        f"app;dur={seconds * 1000:.1f}",
+        f'db;dur={timings.sql_seconds * 1000:.1f};desc="{timings.sql_queries} queries"',
+        f"openlibrary;dur={timings.upstream_seconds * 1000:.1f}"
+        f';desc="{timings.upstream_calls} calls"',
+    ))
+
+
+def init_metrics(app, collectors=()):
+    """Time every request and serve /metrics.
+
+    `collectors` are functions returning more metrics lines. With
+    SERVER_TIMING set, responses carry a Server-Timing header; with
+    METRICS_TOKEN set, /metrics needs it as a bearer token.
+    """
+
+    @app.before_request
+    def start_timings():
+        g.timings_token = current_timings.set(RequestTimings())
+
+    @app.teardown_request
+    def end_timings(error):
+        token = g.pop("timings_token", None)
+        if token is not None:
+            current_timings.reset(token)
+
+    @app.after_request
+    def record_timings(response):
+        timings = current_timings.get()
+        if timings is None:
+            return response
+
+        seconds = time.perf_counter() - timings.start
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        method, status = request.method, response.status_code
+
+        def observe():
+            metrics.observe(route, method, status,
+                            time.perf_counter() - timings.start, timings)
+
+        # a streamed body is still being rendered; count it once it's sent
+        if response.is_streamed:
+            response.call_on_close(observe)
+        else:
+            observe()
+
+        if app.config.get("SERVER_TIMING"):
+            response.headers["Server-Timing"] = server_timing(timings, seconds)
+
+        return response
+
+    def metrics_view():
+        token = app.config.get("METRICS_TOKEN")
+        if token and request.headers.get("Authorization") != f"Bearer {token}":
+            return "Unauthorized", 401
+
+        lines = list(metrics.lines())
+        for collect in collectors:
+            lines.extend(collect())
+
+        return app.response_class("\n".join(lines) + "\n",
+                                  mimetype="text/plain; version=0.0.4")
+
+    metrics_view.cache_control = "no-store"
+    app.add_url_rule("/metrics", "metrics", metrics_view)
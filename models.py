@@ -1,12 +1,19 @@
 """SQLAlchemy models for The Book List."""
 
 from datetime import datetime
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
+
+from passwords import hash_password, check_password, needs_rehash
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# dialects whose insert() supports on_conflict_do_nothing()
+INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
 
 
 
@@ -15,6 +22,13 @@ class Like(db.Model):
 
     __tablename__ = 'likes' 
 
+    __table_args__ = (
+        # one like per user and book; also serves lookups by user_id
+        db.Index('likes_user_id_book_key_idx', 'user_id', 'book_key',
+                 unique=True),
+        db.Index('likes_book_key_idx', 'book_key'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -31,11 +45,77 @@ class Like(db.Model):
 
     user = db.relationship('User')
 
+    # the local copy of the book, if it has been fetched yet
+    book = db.relationship(
+        'Book',
+        primaryjoin='foreign(Like.book_key) == Book.key',
+        viewonly=True,
+    )
+
+    @classmethod
+    def add(cls, user_id, book_key):
+        """Like `book_key` for `user_id` unless they already do.
+
+        A single INSERT ... ON CONFLICT DO NOTHING, so repeated or racing
+        likes never create duplicates. Returns True if a like was added.
+        """
+
+        insert = INSERTS[db.session.get_bind().dialect.name]
+        result = db.session.execute(
+            insert(cls)
+            .values(user_id=user_id, book_key=book_key)
+            .on_conflict_do_nothing(index_elements=['user_id', 'book_key']))
+
+        return result.rowcount == 1
+
+    @classmethod
+    def book_counts(cls, exclude_user_id, order='popular', after=None,
+                    limit=24):
+        """Books liked by readers other than `exclude_user_id`.
+
+        Returns one (book_key, readers, last_like) row per book, where
+        `readers` is how many users like it and `last_like` is the id of
+        its most recent like. `order` is 'popular' (most readers first) or
+        'recent' (most recently liked first).
+
+        Pages are keyset paginated: pass the sort key of the last row of
+        the previous page as `after`, (readers, book_key) for 'popular'
+        and (last_like,) for 'recent'.
+        """
+
+        readers = db.func.count(db.distinct(cls.user_id)).label('readers')
+        last_like = db.func.max(cls.id).label('last_like')
+
+        query = (db.session
+                 .query(cls.book_key, readers, last_like)
+                 .filter(cls.user_id != exclude_user_id)
+                 .group_by(cls.book_key))
+
+        if order == 'recent':
+            if after:
+                query = query.having(last_like < after[0])
+            query = query.order_by(last_like.desc())
+
+        else:
+            if after:
+                query = query.having(db.or_(
+                    readers < after[0],
+                    db.and_(readers == after[0], cls.book_key > after[1])))
+            query = query.order_by(readers.desc(), cls.book_key)
+
+        return query.limit(limit).all()
+
 class Review(db.Model):
     """Mapping user reviews to books."""
 
     __tablename__ = 'reviews' 
 
+    __table_args__ = (
+        # book pages list a book's reviews newest first
+        db.Index('reviews_book_key_timestamp_idx', 'book_key',
+                 db.text('timestamp DESC'), db.text('id DESC')),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -60,11 +140,34 @@ class Review(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user = db.relationship('User')
 
+    @classmethod
+    def page(cls, book_key, after=None, limit=20):
+        """Reviews of `book_key`, newest first.
+
+        Keyset paginated: pass the (timestamp, id) of the last review of
+        the previous page as `after`.
+        """
+
+        # reviewer names come back in the same query
+        query = (cls
+                 .query
+                 .options(db.joinedload(cls.user)
+                          .load_only(User.id, User.username))
+                 .filter(cls.book_key == book_key))
+
+        if after:
+            query = query.filter(db.tuple_(cls.timestamp, cls.id) < after)
+
+        return (query
+                .order_by(cls.timestamp.desc(), cls.id.desc())
+                .limit(limit)
+                .all())
+
 class User(db.Model):
     """User in the system."""
 
@@ -117,7 +220,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -143,13 +246,143 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Whether `password` is this user's password.
+
+        A hash made at another bcrypt cost than BCRYPT_LOG_ROUNDS is
+        replaced with a new one; the caller commits it.
+        """
+
+        if not check_password(self.password, password):
+            return False
+
+        if needs_rehash(self.password):
+            self.password = hash_password(password)
+
+        return True
+
+
+class Book(db.Model):
+    """Local copy of an Open Library work, so pages can render without
+    calling the API."""
+
+    __tablename__ = 'books'
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    title = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    cover_id = db.Column(
+        db.Integer,
+    )
+
+    first_publish_date = db.Column(
+        db.Text,
+    )
+
+    description = db.Column(
+        db.Text,
+    )
+
+    fetched_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    book_authors = db.relationship(
+        'BookAuthor',
+        order_by='BookAuthor.position',
+        cascade='all, delete-orphan',
+    )
+
+    def __repr__(self):
+        return f"<Book {self.key}: {self.title}>"
+
+    @property
+    def author_names(self):
+        return [book_author.author.name for book_author in self.book_authors]
+
+
+class Author(db.Model):
+    """Local copy of an Open Library author."""
+
+    __tablename__ = 'authors'
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    fetched_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class BookAuthor(db.Model):
+    """Mapping books to their authors, in the order the work lists them."""
+
+    __tablename__ = 'book_authors'
+
+    book_key = db.Column(
+        db.Text,
+        db.ForeignKey('books.key', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_key = db.Column(
+        db.Text,
+        db.ForeignKey('authors.key', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    position = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    author = db.relationship('Author')
+
+
+def upgrade_db():
+    """Bring an existing database up to date with the models.
+
+    Creates missing tables, drops duplicate likes (keeping the oldest) so
+    the unique index can be built, then creates any missing indexes.
+    Safe to run more than once.
+    """
+
+    db.create_all()
+
+    db.session.execute(db.text(
+        """DELETE FROM likes WHERE id NOT IN (
+               SELECT MIN(id) FROM likes GROUP BY user_id, book_key
+           )"""))
+    db.session.commit()
+
+    for model in (Like, Review):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,189 @@
+"""A local stand-in for the parts of Open Library the app calls.
+
+Serves made-up works, authors, trending lists, search results and covers
+with a configurable delay and payload size, and counts the calls it gets.
+The benchmark starts one itself; to develop without the network, run
+
+    python openlibrary_stub.py --port 8001
+
+and start the app with OPENLIBRARY_URL and OPENLIBRARY_COVERS_URL set to
+http://127.0.0.1:8001.
+
+Work OL<n>W exists for any n, with cover n and `authors_per_work` authors
+drawn from a pool of `author_pool`, so works share authors the way real
+ones do.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+WORK_PATH = re.compile(r"^/works/OL(\d+)W\.json$")
+AUTHOR_PATH = re.compile(r"^/authors/OL(\d+)A\.json$")
+COVER_PATH = re.compile(r"^/b/id/(\d+)-[SML]\.jpg$")
+WORK_KEY = re.compile(r"/works/OL(\d+)W")
+
+
+class OpenLibraryStub:
+    """Open Library stand-in served from a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0,
+                 authors_per_work=2, author_pool=500, description_bytes=500,
+                 cover_bytes=4096):
+        self.latency = latency
+        self.authors_per_work = authors_per_work
+        self.author_pool = author_pool
+        self.description_bytes = description_bytes
+        self.cover_bytes = cover_bytes
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+        handler = type("Handler", (StubHandler,), {"stub": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever,
+                         name="openlibrary-stub", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def author_numbers(self, n):
+        return [(n * 7 + i) % self.author_pool + 1
+                for i in range(self.authors_per_work)]
+
+    def work(self, n):
+        return {
+            "key": f"/works/OL{n}W",
+            "title": f"Work {n}",
+            "covers": [n],
+            "first_publish_date": f"{1900 + n % 120}",
+            "description": {"type": "/type/text",
+                            "value": "x" * self.description_bytes},
+            "authors": [{"author": {"key": f"/authors/OL{a}A"},
+                         "type": {"key": "/type/author_role"}}
+                        for a in self.author_numbers(n)],
+        }
+
+    def author(self, n):
+        return {"key": f"/authors/OL{n}A", "name": f"Author {n}"}
+
+    def doc(self, n):
+        return {
+            "key": f"/works/OL{n}W",
+            "title": f"Work {n}",
+            "cover_i": n,
+            "first_publish_year": 1900 + n % 120,
+            "author_name": [f"Author {a}" for a in self.author_numbers(n)],
+        }
+
+    def search(self, params):
+        query = params.get("q", [""])[0]
+        limit = int(params.get("limit", ["15"])[0])
+
+        if query.startswith("key:"):
+            numbers = [int(n) for n in WORK_KEY.findall(query)]
+        else:
+            offset = int(params.get("offset", ["0"])[0])
+            numbers = range(offset + 1, offset + limit + 1)
+
+        docs = [self.doc(n) for n in numbers][:limit]
+        return {"numFound": len(docs), "start": 0, "docs": docs}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Routes one request to the stub's made-up data."""
+
+    protocol_version = "HTTP/1.1"
+    stub = None
+
+    def do_GET(self):
+        stub = self.stub
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if match := WORK_PATH.match(url.path):
+            stub.count("works")
+            self.send_json(stub.work(int(match.group(1))))
+
+        elif match := AUTHOR_PATH.match(url.path):
+            stub.count("authors")
+            self.send_json(stub.author(int(match.group(1))))
+
+        elif url.path == "/search.json":
+            stub.count("search")
+            self.send_json(stub.search(params))
+
+        elif url.path == "/trending/now.json":
+            stub.count("trending")
+            limit = int(params.get("limit", ["15"])[0])
+            self.send_json({"works": [stub.doc(n) for n in range(1, limit + 1)]})
+
+        elif COVER_PATH.match(url.path):
+            stub.count("covers")
+            self.send(200, "image/jpeg", b"\xff" * stub.cover_bytes)
+
+        else:
+            stub.count("not found")
+            self.send_json({"error": "notfound"}, status=404)
+
+    def send_json(self, data, status=200):
+        self.send(status, "application/json", json.dumps(data).encode())
+
+    def send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before each response")
+    parser.add_argument("--authors-per-work", type=int, default=2)
+    parser.add_argument("--description-bytes", type=int, default=500)
+    args = parser.parse_args()
+
+    stub = OpenLibraryStub(port=args.port, latency=args.latency,
+                           authors_per_work=args.authors_per_work,
+                           description_bytes=args.description_bytes)
+    print(f"Open Library stub on {stub.url}")
+
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
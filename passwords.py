@@ -0,0 +1,80 @@
+"""Password hashing off the request threads.
+
+bcrypt is slow on purpose, so a burst of logins or signups could keep
+every core busy and stall the pages everyone else is loading. Hashes are
+computed on a small pool of their own (bcrypt releases the GIL while it
+works), which caps how much CPU they can take; requests past that wait
+in its queue. Time spent waiting is recorded in `stats`.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+# bcrypt cost for new hashes; existing hashes are upgraded (or
+# downgraded) to it the next time their user logs in
+BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+
+hash_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BCRYPT_THREADS", 2)),
+    thread_name_prefix="bcrypt")
+
+stats = {"hashes": 0, "checks": 0, "queue_seconds": 0.0,
+         "max_queue_seconds": 0.0, "hash_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def run_hasher(kind, fn, *args):
+    """Run `fn(*args)` on hash_pool and wait for its result, recording
+    how long it queued and how long it ran."""
+
+    queued = time.perf_counter()
+    times = {}
+
+    def timed():
+        times["started"] = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            times["finished"] = time.perf_counter()
+
+    try:
+        return hash_pool.submit(timed).result()
+
+    finally:
+        waited = times.get("started", time.perf_counter()) - queued
+        ran = times.get("finished", 0) - times.get("started", 0)
+
+        with _stats_lock:
+            stats[kind] += 1
+            stats["queue_seconds"] += waited
+            stats["max_queue_seconds"] = max(stats["max_queue_seconds"], waited)
+            stats["hash_seconds"] += ran
+
+
+def hash_password(password):
+    """Hash `password` at the configured cost."""
+
+    return run_hasher("hashes", bcrypt.generate_password_hash,
+                      password, BCRYPT_LOG_ROUNDS).decode('UTF-8')
+
+
+def check_password(pw_hash, password):
+    """Whether `password` matches `pw_hash`."""
+
+    return run_hasher("checks", bcrypt.check_password_hash, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    """Whether `pw_hash` was made at a different cost than configured."""
+
+    try:
+        # $2b$12$<salt and hash>
+        return int(pw_hash.split("$")[2]) != BCRYPT_LOG_ROUNDS
+    except (IndexError, ValueError):
+        return True
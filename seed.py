@@ -1,11 +1,377 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed the database with users, likes and reviews.
+
+Generates synthetic data (or reads it from CSV files) and streams it into
+the database in bulk: COPY on PostgreSQL, batched executemany elsewhere.
+Generated likes and reviews are skewed the way real ones are: a few books
+get most of them and a few users make most of them.
+
+    python seed.py                                       # a small sample
+    python seed.py --users 100000 --likes 5000000 --reviews 1000000
+    python seed.py --users-csv users.csv --likes-csv likes.csv
+
+The database is dropped and recreated first unless --append is given.
+Generated users log in with --password (default "password"), which is
+hashed once for all of them.
+
+CSV files need a header row:
+
+    users.csv    username,email,first_name,last_name, and password (plain
+                 text, hashed once per distinct value) or password_hash
+    likes.csv    username,book_key
+    reviews.csv  username,book_key,review and optionally timestamp (ISO)
+
+Book keys are OL<n>W for n up to --books (the works openlibrary_stub
+serves), or the keys listed one per line in --book-keys, most popular
+first.
+"""
+
+import argparse
+import bisect
+import csv
+import heapq
+import io
+import itertools
+import random
+import sys
+import time
+from datetime import datetime, timedelta
 
-from csv import DictReader
-from app import db
-from models import User, Review, Likes
 from app import app
+from models import db, User, Like, Review
+from passwords import hash_password
+
+FIRST_NAMES = ("Ada", "Ben", "Chloe", "Dev", "Eve", "Femi", "Grace", "Hiro",
+               "Ines", "Jon", "Kiri", "Lena", "Mo", "Nia", "Omar", "Priya")
+LAST_NAMES = ("Achebe", "Bisht", "Chen", "Diaz", "Eze", "Fischer", "Gupta",
+              "Hale", "Ito", "Jones", "Khan", "Lopez", "Moss", "Novak")
+
+
+class Zipf:
+    """Draws from 0..n-1 with probability proportional to 1 / (i+1)**s."""
+
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        self.weights = [1 / (i + 1) ** s for i in range(n)]
+        self.cum_weights = list(itertools.accumulate(self.weights))
+        self.total = self.cum_weights[-1]
+
+    def draw(self):
+        return bisect.bisect(self.cum_weights, self.rng.random() * self.total)
+
+    def distinct(self, k):
+        """`k` different draws (at most n)."""
+
+        n = len(self.weights)
+        k = min(k, n)
+
+        if k * 4 > n:
+            # redrawing until rare values turn up takes forever; take the
+            # k largest of random() ** (1 / weight) instead
+            return heapq.nlargest(
+                k, range(n),
+                key=lambda i: self.rng.random() ** (1 / self.weights[i]))
+
+        picked = set()
+        while len(picked) < k:
+            picked.add(self.draw())
+
+        return picked
+
+
+def book_keys(args):
+    if args.book_keys:
+        with open(args.book_keys) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    return [f"OL{n}W" for n in range(1, args.books + 1)]
+
+
+def likes_per_user(total, users, skew, most, rng):
+    """Split `total` likes over `users` users with a heavy tail: most
+    like a few books, some like hundreds (but no more than `most`).
+
+    Likes cut off at `most` go to the other users, so the counts add up
+    to `total` (within one per user to `most` per user)."""
+
+    weights = [rng.paretovariate(skew) for _ in range(users)]
+    total = max(users, min(total, users * most))
+
+    # find the scale at which the clipped shares add up to total
+    low, high = 0.0, float(total)
+    for _ in range(60):
+        scale = (low + high) / 2
+        if sum(min(max(1, w * scale), most) for w in weights) < total:
+            low = scale
+        else:
+            high = scale
+
+    counts = [min(max(1, int(w * high)), most) for w in weights]
+
+    # rounding down left less than one like per user; the heaviest get it
+    short = total - sum(counts)
+    for i in sorted(range(users), key=weights.__getitem__, reverse=True):
+        if short <= 0:
+            break
+        if counts[i] < most:
+            counts[i] += 1
+            short -= 1
+
+    return counts
+
+
+def generate_users(args, first_id):
+    """(id, username, email, password hash, first name, last name) rows."""
+
+    # one bcrypt hash for everyone, or loading is all hashing
+    pw_hash = hash_password(args.password)
+    rng = random.Random(args.seed)
+
+    for user_id in range(first_id, first_id + args.users):
+        yield (user_id, f"reader{user_id}", f"reader{user_id}@example.com",
+               pw_hash, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+
+def read_users(path, first_id):
+    """User rows from a CSV file, hashing each distinct password once."""
+
+    hashes = {}
+
+    with open(path, newline="") as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            pw_hash = row.get("password_hash")
+            if not pw_hash:
+                if row["password"] not in hashes:
+                    hashes[row["password"]] = hash_password(row["password"])
+                pw_hash = hashes[row["password"]]
+
+            yield (first_id + i, row["username"], row["email"], pw_hash,
+                   row["first_name"], row["last_name"])
+
+
+def generate_likes(args, user_ids, keys):
+    """(user_id, book_key) rows, one per user and book at most."""
+
+    rng = random.Random(args.seed + 1)
+    books = Zipf(len(keys), args.skew, rng)
+
+    # nobody can like more books than there are
+    counts = likes_per_user(args.likes, len(user_ids), args.user_skew,
+                            min(args.max_likes, len(keys)), rng)
+
+    for user_id, count in zip(user_ids, counts):
+        for n in books.distinct(count):
+            yield (user_id, keys[n])
+
+
+def generate_reviews(args, user_ids, keys):
+    """(user_id, book_key, review, timestamp) rows over the past year."""
+
+    rng = random.Random(args.seed + 2)
+    books = Zipf(len(keys), args.skew, rng)
+    users = Zipf(len(user_ids), args.skew, rng)
+    now = datetime.utcnow()
+
+    for i in range(args.reviews):
+        yield (user_ids[users.draw()], keys[books.draw()],
+               f"Review {i}: " + "a good read. " * rng.randint(1, 20),
+               now - timedelta(seconds=rng.randint(0, 365 * 24 * 60 * 60)))
+
+
+def read_rows(path, columns, usernames):
+    """Like or review rows from a CSV file with a username column.
+
+    Rows for unknown users are skipped, as are repeated likes.
+    """
+
+    seen = set()
+
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            user_id = usernames.get(row["username"])
+            if user_id is None:
+                continue
+
+            values = [user_id] + [row.get(column) for column in columns]
+
+            if "review" not in columns:
+                if (user_id, row["book_key"]) in seen:
+                    continue
+                seen.add((user_id, row["book_key"]))
+            elif values[-1]:
+                values[-1] = datetime.fromisoformat(values[-1])
+            else:
+                values[-1] = datetime.utcnow()
+
+            yield tuple(values)
+
+
+class CSVStream(io.RawIOBase):
+    """Reads `rows` as CSV, generating them only as COPY asks for more."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) < len(b):
+            chunk = io.StringIO()
+            writer = csv.writer(chunk)
+            writer.writerows(itertools.islice(self.rows, 1000))
+
+            if not chunk.tell():
+                break
+            self.buffer += chunk.getvalue().encode()
+
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+
+        return n
+
+
+def load(table, columns, rows, batch):
+    """Stream `rows` (tuples in `columns` order) into `table`. Returns how
+    many were loaded."""
+
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    if db.engine.dialect.name == "postgresql":
+        conn = db.engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {table.name} ({', '.join(columns)}) FROM STDIN"
+                    " WITH (FORMAT csv)",
+                    io.BufferedReader(CSVStream(counted()), 1 << 16))
+            conn.commit()
+        finally:
+            conn.close()
+
+    else:
+        insert = table.insert()
+        stream = counted()
+        with db.engine.begin() as conn:
+            while chunk := list(itertools.islice(stream, batch)):
+                conn.execute(insert, [dict(zip(columns, row)) for row in chunk])
+
+    return count
+
+
+def reset_sequence(table):
+    """Make the id sequence continue after the ids loaded explicitly."""
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'),"
+            f" COALESCE((SELECT MAX(id) FROM {table.name}), 1))"))
+        db.session.commit()
+
+
+def seed(args):
+    indexes = [index for model in (Like, Review)
+               for index in model.__table__.indexes]
+
+    if not args.append:
+        db.drop_all()
+        db.create_all()
+        # building indexes once at the end beats updating them per row
+        for index in indexes:
+            index.drop(db.engine)
+
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    keys = book_keys(args)
+
+    started = time.perf_counter()
+    users = (read_users(args.users_csv, first_id) if args.users_csv
+             else generate_users(args, first_id))
+    count = load(User.__table__, ("id", "username", "email", "password",
+                                  "first_name", "last_name"), users, args.batch)
+    reset_sequence(User.__table__)
+    report("users", count, started)
+
+    user_ids = list(range(first_id, first_id + count))
+
+    started = time.perf_counter()
+    if args.likes_csv:
+        usernames = dict(db.session.query(User.username, User.id))
+        likes = read_rows(args.likes_csv, ("book_key",), usernames)
+    else:
+        likes = generate_likes(args, user_ids, keys)
+    report("likes", load(Like.__table__, ("user_id", "book_key"), likes,
+                         args.batch), started)
+
+    started = time.perf_counter()
+    if args.reviews_csv:
+        usernames = dict(db.session.query(User.username, User.id))
+        reviews = read_rows(args.reviews_csv,
+                            ("book_key", "review", "timestamp"), usernames)
+    else:
+        reviews = generate_reviews(args, user_ids, keys)
+    report("reviews", load(Review.__table__,
+                           ("user_id", "book_key", "review", "timestamp"),
+                           reviews, args.batch), started)
+
+    if not args.append:
+        started = time.perf_counter()
+        for index in indexes:
+            index.create(db.engine)
+        report("indexes", len(indexes), started)
+
+    if db.engine.dialect.name == "postgresql":
+        with db.engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(
+                db.text("ANALYZE"))
+
+
+def report(what, count, started):
+    seconds = time.perf_counter() - started
+    print(f"{what:<8} {count:>10} in {seconds:6.1f}s"
+          f" ({count / seconds if seconds else 0:,.0f}/s)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Seed the database with users, likes and reviews.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--likes", type=int, default=1000,
+                        help="total likes to generate (default 1000; at least"
+                        " one and at most --books per user)")
+    parser.add_argument("--reviews", type=int, default=200)
+    parser.add_argument("--books", type=int, default=500,
+                        help="how many different books to use (default 500)")
+    parser.add_argument("--book-keys",
+                        help="file of work keys to use, most popular first")
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="Zipf exponent of book popularity (default 1.1)")
+    parser.add_argument("--user-skew", type=float, default=1.5,
+                        help="Pareto shape of likes per user; lower means"
+                             " heavier likers (default 1.5)")
+    parser.add_argument("--max-likes", type=int, default=2000,
+                        help="most likes one user makes (default 2000)")
+    parser.add_argument("--password", default="password",
+                        help="password of every generated user")
+    parser.add_argument("--users-csv")
+    parser.add_argument("--likes-csv")
+    parser.add_argument("--reviews-csv")
+    parser.add_argument("--batch", type=int, default=10000,
+                        help="rows per executemany when not on PostgreSQL")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--append", action="store_true",
+                        help="add to the existing data instead of starting over")
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args)
 
-app.app_context().push()
-db.drop_all()
-db.create_all()
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+// Load older reviews in place of the "Older reviews" button.
+$(document).on('click', '[data-more-reviews]', function (evt) {
+  evt.preventDefault();
+  const $item = $(this).closest('li');
+
+  $.get($(this).attr('href'), function (html) {
+    $item.replaceWith(html);
+  });
+});
@@ -0,0 +1,253 @@
+"""Open Library client tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api_helpers.py
+
+
+import socket
+import time
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+import requests
+
+from api_helpers import (OpenLibraryClient, CircuitBreaker, UpstreamUnavailable,
+                         start_budget, end_budget)
+from openlibrary_stub import OpenLibraryStub
+
+
+def fake_response(status=200, data=None, headers=None):
+    resp = Mock(status_code=status, headers=headers or {})
+    resp.json.return_value = data
+    if status >= 400:
+        resp.raise_for_status.side_effect = requests.HTTPError(
+            str(status), response=resp)
+    return resp
+
+
+class OpenLibraryClientTestCase(TestCase):
+    """Test the pooled client."""
+
+    def setUp(self):
+        self.client = OpenLibraryClient(base_url="http://ol.test/")
+
+    def test_work(self):
+        with patch.object(self.client.session, "get",
+                          return_value=fake_response(data={"title": "Kargil"})
+                          ) as get:
+            self.assertEqual(self.client.work("OL1W"), {"title": "Kargil"})
+
+        get.assert_called_once_with("http://ol.test/works/OL1W.json",
+                                    params=None, timeout=self.client.timeout)
+        self.assertEqual(self.client.stats["works"]["calls"], 1)
+        self.assertEqual(self.client.stats["works"]["errors"], 0)
+
+    def test_author_path(self):
+        with patch.object(self.client.session, "get",
+                          return_value=fake_response(data={})) as get:
+            self.client.author("/authors/OL1A")
+
+        self.assertEqual(get.call_args[0][0],
+                         "http://ol.test/authors/OL1A.json")
+
+    def test_retries_server_errors(self):
+        responses = [fake_response(status=503), fake_response(data={"ok": 1})]
+
+        with patch.object(self.client.session, "get",
+                          side_effect=responses) as get:
+            self.assertEqual(self.client.work("OL1W"), {"ok": 1})
+
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(self.client.stats["works"]["calls"], 1)
+
+    def test_retry_after_past_the_budget_gives_up(self):
+        self.addCleanup(end_budget, start_budget(5))
+        busy = fake_response(status=429, headers={"Retry-After": "60"})
+
+        with patch.object(self.client.session, "get",
+                          return_value=busy) as get, \
+                patch("api_helpers.time.sleep") as sleep:
+            with self.assertRaises(requests.HTTPError):
+                self.client.work("OL1W")
+
+        get.assert_called_once()
+        sleep.assert_not_called()
+
+    def test_counts_errors(self):
+        with patch.object(self.client.session, "get",
+                          return_value=fake_response(status=404)):
+            with self.assertRaises(requests.HTTPError):
+                self.client.work("OL1W")
+
+        with patch.object(self.client.session, "get",
+                          side_effect=requests.ConnectionError()):
+            with self.assertRaises(requests.ConnectionError):
+                self.client.work("OL1W")
+
+        self.assertEqual(self.client.stats["works"]["calls"], 2)
+        self.assertEqual(self.client.stats["works"]["errors"], 2)
+
+
+class CircuitBreakerTestCase(TestCase):
+    """Test failing fast on an endpoint that keeps failing."""
+
+    def setUp(self):
+        self.client = OpenLibraryClient(base_url="http://ol.test/",
+                                        breaker_threshold=2,
+                                        breaker_cooldown=60)
+        self.addCleanup(start_budget, None)
+
+    def fail_twice(self):
+        with patch.object(self.client.session, "get",
+                          side_effect=requests.ConnectionError()):
+            for _ in range(2):
+                with self.assertRaises(requests.ConnectionError):
+                    self.client.work("OL1W")
+
+    def test_opens_after_failures(self):
+        self.fail_twice()
+
+        with patch.object(self.client.session, "get") as get:
+            with self.assertRaises(UpstreamUnavailable):
+                self.client.work("OL1W")
+
+        get.assert_not_called()
+        breaker = self.client.breakers["works"]
+        self.assertEqual((breaker.state, breaker.trips, breaker.rejected),
+                         (CircuitBreaker.OPEN, 1, 1))
+        # other endpoints are still called
+        self.assertNotIn("authors", self.client.breakers)
+
+    def test_half_open_probe(self):
+        self.fail_twice()
+        breaker = self.client.breakers["works"]
+        breaker.opened_at -= 60
+
+        with patch.object(self.client.session, "get",
+                          side_effect=requests.ConnectionError()):
+            with self.assertRaises(requests.ConnectionError):
+                self.client.work("OL1W")
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        breaker.opened_at -= 60
+        with patch.object(self.client.session, "get",
+                          return_value=fake_response(data={})):
+            self.client.work("OL1W")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_not_found_is_not_a_failure(self):
+        with patch.object(self.client.session, "get",
+                          return_value=fake_response(status=404)):
+            for _ in range(3):
+                with self.assertRaises(requests.HTTPError):
+                    self.client.work("OL1W")
+
+        self.assertEqual(self.client.breakers["works"].state,
+                         CircuitBreaker.CLOSED)
+
+    def test_budget(self):
+        start_budget(5)
+        with patch.object(self.client.session, "get",
+                          return_value=fake_response(data={})) as get:
+            self.client.work("OL1W")
+
+        # time left for retries, with the read timeout cut to the budget
+        self.assertEqual(get.call_args[1]["timeout"][0], 3.05)
+        self.assertLessEqual(get.call_args[1]["timeout"][1], 5)
+
+        start_budget(1)
+        with patch.object(self.client.session, "get",
+                          return_value=fake_response(data={})) as get:
+            self.client.work("OL1W")
+
+        self.assertLessEqual(get.call_args[1]["timeout"][1], 1)
+
+        start_budget(0)
+        with self.assertRaises(UpstreamUnavailable):
+            self.client.work("OL1W")
+
+    def test_connect_timeouts_open_the_circuit(self):
+        # a listener whose backlog is full drops new connections, so
+        # connecting to it times out like connecting to a dead host
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(0)
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+
+        for _ in range(3):
+            filler = socket.socket()
+            filler.setblocking(False)
+            filler.connect_ex(("127.0.0.1", port))
+            self.addCleanup(filler.close)
+        time.sleep(0.05)
+
+        client = OpenLibraryClient(base_url=f"http://127.0.0.1:{port}",
+                                   connect_timeout=0.05, retries=0,
+                                   breaker_threshold=2)
+        start_budget(5)
+
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectTimeout):
+                client.work("OL1W")
+
+        self.assertEqual(client.breakers["works"].state, CircuitBreaker.OPEN)
+
+
+class OpenLibraryStubTestCase(TestCase):
+    """Test the client against the local Open Library stand-in."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = OpenLibraryStub(authors_per_work=3).start()
+        cls.client = OpenLibraryClient(base_url=cls.stub.url,
+                                       covers_url=cls.stub.url)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+
+    def test_work_and_authors(self):
+        work = self.client.work("OL5W")
+        author = self.client.author(work["authors"][0]["author"]["key"])
+
+        self.assertEqual(work["title"], "Work 5")
+        self.assertEqual(len(work["authors"]), 3)
+        self.assertTrue(author["name"].startswith("Author "))
+
+    def test_search_by_keys(self):
+        docs = self.client.search(
+            {"q": 'key:("/works/OL1W" OR "/works/OL9W")'})["docs"]
+
+        self.assertEqual([doc["key"] for doc in docs],
+                         ["/works/OL1W", "/works/OL9W"])
+
+    def test_slow_upstream_stays_within_budget(self):
+        client = OpenLibraryClient(base_url=self.stub.url)
+        self.stub.latency = 1
+        self.addCleanup(setattr, self.stub, "latency", 0.0)
+        self.addCleanup(end_budget, start_budget(0.5))
+
+        start = time.monotonic()
+        with patch.object(client.session, "get",
+                          wraps=client.session.get) as get:
+            with self.assertRaises(requests.Timeout):
+                client.work("OL1W")
+
+        self.assertLess(time.monotonic() - start, 0.9)
+        get.assert_called_once()
+        # we cut that timeout short, so it doesn't count against the circuit
+        self.assertEqual(client.breakers["works"].failures, 0)
+
+    def test_counts_calls(self):
+        self.stub.reset()
+        self.client.trending(limit=5)
+        self.client.cover(7, "S")
+
+        with self.assertRaises(requests.HTTPError):
+            self.client.get_json("works", "/nothing.json")
+
+        self.assertEqual(self.stub.calls["trending"], 1)
+        self.assertEqual(self.stub.calls["covers"], 1)
+        self.assertEqual(self.stub.calls["not found"], 1)
@@ -0,0 +1,327 @@
+"""Book View tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_book_views.py
+
+
+import os
+import re
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+from urllib.parse import unquote
+
+import http_caching
+from models import db, User, Review
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///the-book-list-test"
+os.environ['BOOK_CACHE_PATH'] = ""
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, CURR_USERNAME_KEY, parse_reviews_cursor
+from helpers import make_book_async
+
+ctx = app.app_context()
+ctx.push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['TESTING'] = True
+
+
+async def fake_book(key):
+    return {
+        "title": "Kargil",
+        "published": "2019",
+        "description": "No description",
+        "authors": ["Rachna Bisht Rawat"],
+        "cover": 10859107,
+        "key": key
+    }
+
+
+@patch("app.make_book_async", fake_book)
+class BookViewTestCase(TestCase):
+    """Test views for books."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    first_name="Test",
+                                    last_name="User",
+                                    email="test@test.com",
+                                    password="testuser")
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+        for i in range(5):
+            reviewer = User.signup(username=f"reviewer{i}",
+                                   first_name="Re",
+                                   last_name="Viewer",
+                                   email=f"reviewer{i}@test.com",
+                                   password="password")
+            db.session.flush()
+            db.session.add(Review(review=f"Review {i}",
+                                  book_key="OL1W",
+                                  user_id=reviewer.id))
+        db.session.commit()
+
+        # start requests with an empty identity map, as in production
+        db.session.expunge_all()
+
+    def tearDown(self):
+        resp = super().tearDown()
+        db.session.rollback()
+        app.config['SQL_QUERY_BUDGET'] = None
+        return resp
+
+    def test_book_reviews_no_n_plus_one(self):
+        """Reviewer names load with the reviews, not one query each."""
+
+        # the catalog lookup and the reviews; the current user comes
+        # from the session
+        app.config['SQL_QUERY_BUDGET'] = 2
+
+        # count the real catalog lookup; only Open Library is faked
+        with patch("app.make_book_async", make_book_async), \
+                patch("helpers.fetch_book_async", fake_book), \
+                self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_USERNAME_KEY] = "testuser"
+
+            resp = c.get("/books/book/OL1W")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Review 4 - by reviewer4", str(resp.data))
+
+    def test_old_session_gets_username(self):
+        """Sessions with just a user id load the user once."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/books/book/OL1W")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("testuser", str(resp.data))
+
+            with c.session_transaction() as sess:
+                self.assertEqual(sess[CURR_USERNAME_KEY], "testuser")
+
+    def test_book_etag(self):
+        """A current If-None-Match gets a 304 with no body."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_USERNAME_KEY] = "testuser"
+
+            resp = c.get("/books/book/OL1W")
+            etag = resp.headers["ETag"]
+
+            self.assertTrue(etag.startswith('W/'))
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+            resp = c.get("/books/book/OL1W", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            db.session.add(Review(review="New", book_key="OL1W",
+                                  user_id=self.testuser_id))
+            db.session.commit()
+            resp = c.get("/books/book/OL1W", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_static_change_invalidates_etag(self):
+        """A deploy that only changes CSS or JS gets pages that link to
+        the new versions."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_USERNAME_KEY] = "testuser"
+
+            etag = c.get("/books/book/OL1W").headers["ETag"]
+
+            with patch.dict(http_caching._fingerprints,
+                            {app.static_folder: "newstatics"}):
+                resp = c.get("/books/book/OL1W",
+                             headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+
+
+class ReviewsPageTestCase(TestCase):
+    """Test paging through a book's reviews."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        # reviews 1 to 3 were written in the same instant
+        times = [datetime(2024, 1, 1), datetime(2024, 1, 2),
+                 datetime(2024, 1, 2), datetime(2024, 1, 2),
+                 datetime(2024, 1, 3)]
+
+        for i, timestamp in enumerate(times):
+            reviewer = User.signup(username=f"reviewer{i}",
+                                   first_name="Re",
+                                   last_name="Viewer",
+                                   email=f"reviewer{i}@test.com",
+                                   password="password")
+            db.session.flush()
+            db.session.add(Review(review=f"Review {i}",
+                                  book_key="OL1W",
+                                  user_id=reviewer.id,
+                                  timestamp=timestamp))
+            db.session.flush()
+        db.session.commit()
+        self.testuser_id = reviewer.id
+
+        # start requests with an empty identity map, as in production
+        db.session.expunge_all()
+
+        app.config['REVIEWS_PAGE_SIZE'] = 2
+
+    def tearDown(self):
+        resp = super().tearDown()
+        db.session.rollback()
+        app.config['REVIEWS_PAGE_SIZE'] = 20
+        app.config['SQL_QUERY_BUDGET'] = None
+        return resp
+
+    def get_reviews(self, after=None):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_USERNAME_KEY] = "reviewer4"
+
+            resp = c.get("/books/book/OL1W/reviews",
+                         query_string={"after": after} if after else None)
+
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        after = re.search(r'after=([^"]+)"', html)
+
+        return (re.findall(r"(Review \d) - by reviewer\d", html),
+                unquote(after.group(1)) if after else None)
+
+    def test_page_size(self):
+        reviews, after = self.get_reviews()
+
+        self.assertEqual(reviews, ["Review 4", "Review 3"])
+        self.assertIsNotNone(after)
+
+    def test_pages_resume(self):
+        """Reviews written in the same instant are neither skipped nor
+        repeated across pages."""
+
+        seen, after = self.get_reviews()
+
+        while after:
+            reviews, after = self.get_reviews(after)
+            seen += reviews
+
+        self.assertEqual(seen, ["Review 4", "Review 3", "Review 2",
+                                "Review 1", "Review 0"])
+
+    def test_cursor_round_trip(self):
+        timestamp = datetime(2024, 1, 2, 3, 4, 5, 678901)
+
+        self.assertEqual(parse_reviews_cursor(f"{timestamp.isoformat()}_42"),
+                         (timestamp, 42))
+
+    def test_bad_cursor(self):
+        """A malformed cursor starts from the first page."""
+
+        for after in ("nonsense", "2024-01-02_x", "yesterday_3"):
+            self.assertEqual(self.get_reviews(after)[0],
+                             ["Review 4", "Review 3"])
+
+    def test_reviewers_load_with_reviews(self):
+        """The reviewer names come in the one query for the page."""
+
+        app.config['SQL_QUERY_BUDGET'] = 1
+
+        reviews, after = self.get_reviews()
+        reviews, after = self.get_reviews(after)
+
+        self.assertEqual(reviews, ["Review 2", "Review 1"])
+
+
+class CoverViewTestCase(TestCase):
+    """Test serving covers from the cover cache."""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_cover(self):
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+            f.write(b"jpeg")
+            f.flush()
+
+            with patch("app.get_cover", return_value=f.name) as get_cover:
+                resp = self.client.get("/covers/42-M.jpg")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, b"jpeg")
+            resp.close()
+
+        get_cover.assert_called_once_with(42, "M")
+        self.assertEqual(resp.headers["Cache-Control"],
+                         "public, max-age=31536000, immutable")
+
+    def test_missing_cover(self):
+        """Open Library has no such cover: the placeholder, for a day."""
+
+        with patch("app.get_cover", return_value=None):
+            resp = self.client.get("/covers/42-M.jpg")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("no-cover.svg", resp.headers["Location"])
+        self.assertEqual(resp.headers["Cache-Control"], "public, max-age=86400")
+
+    def test_upstream_error(self):
+        """The placeholder isn't kept when the cover couldn't be fetched."""
+
+        with patch("app.get_cover", side_effect=requests.ConnectionError):
+            resp = self.client.get("/covers/42-M.jpg")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("no-cover.svg", resp.headers["Location"])
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+    def test_invalid_cover(self):
+        with patch("app.get_cover") as get_cover:
+            for url in ("/covers/abc-M.jpg", "/covers/42-XL.jpg"):
+                resp = self.client.get(url)
+
+                self.assertEqual(resp.status_code, 302)
+                self.assertIn("no-cover.svg", resp.headers["Location"])
+
+        get_cover.assert_not_called()
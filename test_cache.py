@@ -0,0 +1,286 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from cache import (LRUCache, DiskCache, FileCache, SingleFlight, TieredCache,
+                   write_snapshot, read_snapshot)
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process tier."""
+
+    def test_get_set(self):
+        c = LRUCache(maxsize=2, ttl=60)
+        c.set("a", 1)
+
+        self.assertEqual(c.get("a"), 1)
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.stats()["hits"], 1)
+        self.assertEqual(c.stats()["misses"], 1)
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(maxsize=2, ttl=60)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.get("a")
+        c.set("c", 3)
+
+        self.assertEqual(c.get("a"), 1)
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.evictions, 1)
+
+    def test_expires(self):
+        c = LRUCache(maxsize=2, ttl=60)
+        c.set("a", 1, ttl=0)
+
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(len(c), 0)
+
+
+class DiskCacheTestCase(TestCase):
+    """Test the shared SQLite tier."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_shared_between_instances(self):
+        DiskCache(self.path).set("work:OL1W", {"title": "Kargil"})
+
+        self.assertEqual(DiskCache(self.path).get("work:OL1W"),
+                         {"title": "Kargil"})
+
+    def test_get_many(self):
+        c = DiskCache(self.path)
+        c.set("a", 1)
+        c.set("b", "")
+        c.set("expired", 3, ttl=0)
+
+        self.assertEqual(c.get_many(["a", "b", "c", "expired", "a"]),
+                         {"a": 1, "b": ""})
+        self.assertEqual(c.hits, 2)
+        self.assertEqual(c.misses, 2)
+
+    def test_evict(self):
+        c = DiskCache(self.path, maxsize=2)
+        c.set("expired", 0, ttl=0)
+        for key in ("a", "b", "c"):
+            c.set(key, key)
+            time.sleep(0.01)
+        c.evict()
+
+        self.assertEqual(len(c), 2)
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(c.get("c"), "c")
+        self.assertEqual(c.evictions, 2)
+
+
+    def test_stale_entries_kept_for_get_stale(self):
+        c = DiskCache(self.path, stale_ttl=60)
+        c.set("old", 1, ttl=0)
+        c.set("gone", 2, ttl=-120)
+        c.evict()
+
+        self.assertIsNone(c.get("old"))
+        self.assertEqual(c.get_stale("old"), 1)
+        self.assertIsNone(c.get_stale("gone"))
+        self.assertEqual(len(c), 1)
+
+
+class TieredCacheTestCase(TestCase):
+    """Test the two tiers together."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_get_or_set_fetches_once(self):
+        c = TieredCache(LRUCache(), DiskCache(self.path))
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {"name": "Rachna Bisht Rawat"}
+
+        c.get_or_set("author:/authors/OL1A", fetch)
+        c.get_or_set("author:/authors/OL1A", fetch)
+
+        self.assertEqual(len(calls), 1)
+
+    def test_get_many_reads_shared_for_local_misses(self):
+        c = TieredCache(LRUCache(), DiskCache(self.path))
+        c.set("a", 1)
+        c.shared.set("b", 2)
+
+        self.assertEqual(c.get_many(["a", "b", "c"]), {"a": 1, "b": 2})
+        self.assertEqual(c.local.get("b"), 2)
+        self.assertEqual(c.shared.hits, 1)
+
+    def test_promotes_from_shared(self):
+        c = TieredCache(LRUCache(), DiskCache(self.path))
+        c.shared.set("a", 1)
+
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.local.get("a"), 1)
+
+
+    def test_get_or_set_serves_stale_on_error(self):
+        c = TieredCache(LRUCache(), DiskCache(self.path, stale_ttl=60))
+        c.set("work:OL1W", {"title": "Kargil"}, ttl=0)
+
+        def fetch():
+            raise ConnectionError("down")
+
+        self.assertEqual(c.get_or_set("work:OL1W", fetch,
+                                      stale_on=ConnectionError),
+                         {"title": "Kargil"})
+
+        with self.assertRaises(ConnectionError):
+            c.get_or_set("work:OL1W", fetch)
+        with self.assertRaises(ConnectionError):
+            c.get_or_set("work:OL2W", fetch, stale_on=ConnectionError)
+
+
+class SingleFlightTestCase(TestCase):
+    """Test request coalescing."""
+
+    def test_collapses_concurrent_calls(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "result"
+
+        def call():
+            results.append(flight.do("key", fetch))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while flight.collapsed < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["result"] * 5)
+
+    def test_shares_errors(self):
+        flight = SingleFlight()
+
+        with self.assertRaises(ValueError):
+            flight.do("key", lambda: int("x"))
+
+        self.assertEqual(flight.do("key", lambda: 1), 1)
+
+
+class FileCacheTestCase(TestCase):
+    """Test the cover file store."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        c = FileCache(self.directory)
+        path = c.put("1-S.jpg", b"jpeg")
+
+        self.assertEqual(c.get("1-S.jpg"), path)
+        self.assertIsNone(c.get("2-S.jpg"))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"jpeg")
+
+    def test_evicts_least_recently_used(self):
+        c = FileCache(self.directory, max_bytes=8)
+        for i, name in enumerate(("a", "b", "c")):
+            path = c.put(name, b"1234")
+            os.utime(path, (i, i))
+        c.evict()
+
+        self.assertIsNone(c.get("a"))
+        self.assertIsNotNone(c.get("c"))
+        self.assertEqual(c.evictions, 1)
+
+
+class SnapshotTestCase(TestCase):
+    """Test exporting and importing cache snapshots."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot.jsonl.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def disk_cache(self, name):
+        return TieredCache(LRUCache(),
+                           DiskCache(os.path.join(self.directory, name)))
+
+    def test_round_trip(self):
+        source = self.disk_cache("source.sqlite3")
+        source.set("work:OL1W", {"title": "Kargil"})
+        source.set("author_name:/authors/OL1A", "")
+        source.set("session:1", "not exported")
+
+        count = write_snapshot(source, self.path, ("work:", "author_name:"))
+        target = self.disk_cache("target.sqlite3")
+
+        self.assertEqual(count, 2)
+        self.assertEqual(read_snapshot(target, self.path), 2)
+        self.assertEqual(target.get("work:OL1W"), {"title": "Kargil"})
+        self.assertEqual(target.get("author_name:/authors/OL1A"), "")
+        self.assertIsNone(target.get("session:1"))
+
+    def test_keeps_newer_entries(self):
+        source = TieredCache(LRUCache())
+        source.set("work:OL1W", "old")
+        write_snapshot(source, self.path, ("work:",))
+
+        target = TieredCache(LRUCache())
+        target.set("work:OL1W", "new")
+        read_snapshot(target, self.path)
+
+        self.assertEqual(target.get("work:OL1W"), "new")
+
+    def test_expired_entries(self):
+        source = TieredCache(LRUCache())
+        source.set("work:OL1W", "soon gone", ttl=0.05)
+        write_snapshot(source, self.path, ("work:",))
+        time.sleep(0.1)
+
+        self.assertEqual(read_snapshot(TieredCache(LRUCache()), self.path), 0)
+
+        fixture = TieredCache(LRUCache())
+        self.assertEqual(read_snapshot(fixture, self.path, ttl=60), 1)
+        self.assertEqual(fixture.get("work:OL1W"), "soon gone")
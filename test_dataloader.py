@@ -0,0 +1,84 @@
+"""Dataloader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_dataloader.py
+
+
+import contextvars
+from unittest import TestCase
+
+from flask import Flask, stream_with_context
+
+from dataloader import DataLoader, loader, start_scope, init_loaders, _scope
+
+
+class DataLoaderTestCase(TestCase):
+    """Test request-scoped batching."""
+
+    def setUp(self):
+        self.batches = []
+
+    def batch(self, keys):
+        self.batches.append(list(keys))
+        return [key.upper() for key in keys]
+
+    def test_dedupes_and_batches(self):
+        load = DataLoader(self.batch)
+
+        self.assertEqual(load.load_many(["a", "b", "a"]), ["A", "B", "A"])
+        self.assertEqual(load.load("b"), "B")
+        self.assertEqual(load.load_many(["c", "a"]), ["C", "A"])
+        self.assertEqual(self.batches, [["a", "b"], ["c"]])
+
+    def test_errors_are_not_remembered(self):
+        calls = []
+
+        def flaky(keys):
+            calls.append(keys)
+            if len(calls) == 1:
+                raise ValueError("upstream")
+            return keys
+
+        load = DataLoader(flaky)
+        with self.assertRaises(ValueError):
+            load.load("a")
+
+        self.assertEqual(load.load("a"), "a")
+
+    def test_scope_shared_by_copied_contexts(self):
+        def in_request():
+            start_scope()
+            loader("words", self.batch).load("a")
+            contextvars.copy_context().run(
+                lambda: loader("words", self.batch).load("a"))
+
+        contextvars.copy_context().run(in_request)
+
+        self.assertEqual(self.batches, [["a"]])
+
+    def test_no_scope_no_memo(self):
+        contextvars.copy_context().run(
+            lambda: [loader("words", self.batch).load("a") for _ in range(2)])
+
+        self.assertEqual(self.batches, [["a"], ["a"]])
+
+    def test_request_scope_ends_with_the_request(self):
+        app = Flask(__name__)
+        init_loaders(app)
+        seen = []
+
+        @app.route('/stream')
+        def stream():
+            def body():
+                seen.append(_scope.get())
+                yield "ok"
+
+            return app.response_class(stream_with_context(body()))
+
+        resp = app.test_client().get('/stream')
+        resp.get_data()
+        resp.close()
+
+        self.assertIsNotNone(seen[0])
+        self.assertIsNone(_scope.get())
@@ -0,0 +1,88 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+import fragments
+from fragments import card_deck, card_rows, init_fragments, invalidate_cards
+from http_caching import init_http_caching
+
+app = Flask(__name__)
+init_http_caching(app)
+init_fragments(app)
+
+
+def make_book(key, title="Kargil"):
+    return {"key": key, "title": title, "cover": 12,
+            "authors": ["Rachna Bisht Rawat"], "published": "2019"}
+
+
+class CardDeckTestCase(TestCase):
+    """Test rendering cached book cards."""
+
+    def setUp(self):
+        fragments.fragments.clear()
+        self.ctx = app.test_request_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_rows(self):
+        html = card_deck([make_book(f"OL{i}W") for i in range(4)], "likes")
+
+        self.assertEqual(html.count('class="row card-deck"'), 2)
+        self.assertEqual(html.count('class="col-4 card"'), 4)
+        self.assertIn('href="OL3W"', html)
+        self.assertIn("/covers/12-S.jpg", html)
+
+    def test_rows_from_a_generator(self):
+        taken = []
+
+        def books():
+            for i in range(5):
+                taken.append(i)
+                yield make_book(f"OL{i}W")
+
+        rows = card_rows(books(), "likes")
+        first = next(rows)
+
+        self.assertEqual(first.count('class="col-4 card"'), 3)
+        self.assertEqual(taken, [0, 1, 2])
+        self.assertEqual(len(list(rows)), 1)
+
+    def test_renders_each_card_once(self):
+        books = [make_book("OL1W")]
+
+        with patch("fragments.render_template",
+                   wraps=fragments.render_template) as render:
+            first = card_deck(books, "likes")
+            second = card_deck(books, "likes")
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first, second)
+
+    def test_changed_data_renders_again(self):
+        card_deck([make_book("OL1W")], "likes")
+        html = card_deck([make_book("OL1W", title="Kargil 1999")], "likes")
+
+        self.assertIn("Kargil 1999", html)
+
+    def test_invalidate(self):
+        card_deck([make_book("OL1W")], "likes")
+        card_deck([dict(make_book("OL1W"), readers=3)], "readers")
+        invalidate_cards("OL1W")
+
+        self.assertEqual(len(fragments.fragments), 0)
+
+    def test_escapes(self):
+        html = card_deck([make_book("OL1W", title="<b>Bold</b>")], "likes")
+
+        self.assertIn("&lt;b&gt;Bold&lt;/b&gt;", html)
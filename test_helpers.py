@@ -0,0 +1,341 @@
+"""Helpers tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_helpers.py
+
+
+import contextvars
+import os
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch, Mock
+
+import requests
+from sqlalchemy.exc import IntegrityError
+
+# keep the tests off the shared disk cache
+os.environ['BOOK_CACHE_PATH'] = ""
+
+import helpers
+from cache import LRUCache, TieredCache
+from dataloader import start_scope
+from helpers import bounded_map, get_author_names
+
+
+class BoundedMapTestCase(TestCase):
+    """Test concurrent fan-out."""
+
+    def test_keeps_order(self):
+        def slow_echo(n):
+            time.sleep((5 - n) * 0.01)
+            return n
+
+        self.assertEqual(bounded_map(slow_echo, range(5), 5), [0, 1, 2, 3, 4])
+
+    def test_respects_limit(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def track(n):
+            with lock:
+                running.append(n)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(n)
+
+        bounded_map(track, range(10), 3)
+
+        self.assertLessEqual(max(peak), 3)
+
+
+class AuthorNamesTestCase(TestCase):
+    """Test author resolution."""
+
+    def setUp(self):
+        helpers.cache.clear()
+
+    def test_dedupes_in_order(self):
+        names = {"/authors/OL1A": "B", "/authors/OL2A": "A"}
+
+        with patch.object(helpers, "fetch_author_name", names.get):
+            result = get_author_names(
+                ["/authors/OL1A", "/authors/OL2A", "/authors/OL1A"])
+
+        self.assertEqual(result, ["B", "A"])
+
+    def test_nameless_and_missing_authors(self):
+        def author(key):
+            if key == "/authors/OL3A":
+                raise requests.HTTPError(response=Mock(status_code=404))
+            return {"/authors/OL1A": {"name": "A"},
+                    "/authors/OL2A": {"personal_name": "B"}}.get(key, {})
+
+        keys = ["/authors/OL1A", "/authors/OL2A", "/authors/OL3A",
+                "/authors/OL4A"]
+
+        with patch.object(helpers.client, "author", author):
+            self.assertEqual(get_author_names(keys), ["A", "B"])
+
+        with patch.object(helpers.client, "author",
+                          side_effect=AssertionError("no upstream call")):
+            self.assertEqual(get_author_names(keys), ["A", "B"])
+
+    def test_other_errors_are_not_cached(self):
+        with patch.object(helpers.client, "author",
+                          side_effect=requests.ConnectionError()):
+            with self.assertRaises(requests.ConnectionError):
+                get_author_names(["/authors/OL1A"])
+
+        with patch.object(helpers.client, "author",
+                          return_value={"name": "A"}):
+            self.assertEqual(get_author_names(["/authors/OL1A"]), ["A"])
+
+
+class FetchBooksTestCase(TestCase):
+    """Test fetching works and shared authors once per request."""
+
+    def test_fetches_each_key_once_without_a_cache(self):
+        works = {"OL1W": ["/authors/OL1A", "/authors/OL2A"],
+                 "OL2W": ["/authors/OL2A"]}
+        calls = []
+
+        def work(key):
+            calls.append(key)
+            return {"title": key, "authors": [{"author": {"key": a}}
+                                              for a in works[key]]}
+
+        def author(key):
+            calls.append(key)
+            return {"name": key.rsplit("/", 1)[1]}
+
+        def in_request():
+            start_scope()
+            books = helpers.fetch_books(["OL1W", "OL2W", "OL1W"])
+            # a later call in the same request reuses what was loaded
+            books += helpers.fetch_books(["OL2W"])
+            return books
+
+        no_cache = TieredCache(LRUCache(maxsize=0))
+
+        with patch.object(helpers, "cache", no_cache), \
+             patch.object(helpers.client, "work", work), \
+             patch.object(helpers.client, "author", author):
+            books = contextvars.copy_context().run(in_request)
+
+        self.assertEqual(sorted(calls), ["/authors/OL1A", "/authors/OL2A",
+                                         "OL1W", "OL2W"])
+        self.assertEqual(books[0]["authors"], ["OL1A", "OL2A"])
+        self.assertEqual(books[3]["authors"], ["OL2A"])
+
+
+class SaveBookQuietlyTestCase(TestCase):
+    """Test that storing a liked or reviewed book never fails the action."""
+
+    def test_swallows_errors(self):
+        errors = [requests.ConnectionError(), KeyError("title"),
+                  IntegrityError("INSERT", {}, Exception("duplicate key"))]
+
+        for error in errors:
+            with patch.object(helpers, "save_book", side_effect=error), \
+                 patch.object(helpers.db, "session") as session, \
+                 patch.object(helpers.log, "exception"):
+                helpers.save_book_quietly("OL1W")
+
+            session.rollback.assert_called_once()
+
+
+class BoundedImapTestCase(TestCase):
+    """Test streaming results off the fetch pool."""
+
+    def test_in_order_and_started_early(self):
+        started = []
+
+        def fn(n):
+            started.append(n)
+            time.sleep(0.05 * (3 - n))
+            return n * 10
+
+        results = helpers.bounded_imap(fn, [0, 1, 2, 3], 2)
+        time.sleep(0.01)
+
+        self.assertEqual(sorted(started), [0, 1])
+        self.assertEqual(list(results), [0, 10, 20, 30])
+
+
+class MakeCardsTestCase(TestCase):
+    """Test batched card hydration."""
+
+    def setUp(self):
+        helpers.cache.clear()
+
+    def test_batches_and_falls_back_for_misses(self):
+        searched = []
+
+        def search_works(keys):
+            searched.append(list(keys))
+            return [{"key": f"/works/{key}", "title": key}
+                    for key in keys if key != "OL3W"]
+
+        def fetch_books(keys):
+            return [{"key": key, "title": "fallback"} for key in keys]
+
+        with patch.object(helpers, "SEARCH_BATCH", 2), \
+             patch.object(helpers, "search_works", search_works), \
+             patch.object(helpers, "fetch_books", fetch_books):
+            cards = helpers.make_cards(["OL1W", "OL2W", "OL1W", "OL3W"])
+
+        self.assertEqual(sorted(map(sorted, searched)),
+                         [["OL1W", "OL2W"], ["OL3W"]])
+        self.assertEqual(cards["OL1W"]["title"], "OL1W")
+        self.assertEqual(cards["OL3W"]["title"], "fallback")
+
+    def test_degrades_when_upstream_fails(self):
+        helpers.cache.set("work:OL2W", {"title": "Kargil"})
+
+        with patch.object(helpers, "search_works",
+                          side_effect=requests.ConnectionError()), \
+             patch.object(helpers, "fetch_books",
+                          side_effect=requests.ConnectionError()):
+            cards = helpers.make_cards(["OL1W", "OL2W"])
+
+        self.assertEqual(cards["OL1W"]["title"], "Title unavailable")
+        self.assertEqual(cards["OL2W"]["title"], "Kargil")
+        self.assertEqual(cards["OL2W"]["authors"], [])
+        self.assertTrue(cards["OL2W"]["degraded"])
+
+    def test_uses_cached_cards(self):
+        helpers.cache.set("card:OL1W", {"key": "OL1W", "title": "cached"})
+
+        with patch.object(helpers, "search_works",
+                          side_effect=AssertionError("no upstream call")):
+            cards = helpers.make_cards(["OL1W"])
+
+        self.assertEqual(cards["OL1W"]["title"], "cached")
+
+
+@patch.object(helpers, "refresh_books", Mock())
+@patch.object(helpers, "is_stale", lambda book: False)
+@patch.object(helpers, "book_from_row", lambda book: {"key": book, "title": "row"})
+class IterBooksTestCase(TestCase):
+    """Test yielding list page books as they are fetched."""
+
+    def test_catalog_books_come_while_fetching(self):
+        fetched = []
+        release = threading.Event()
+
+        def make_cards(keys):
+            release.wait(5)
+            fetched.append(list(keys))
+            return {key: {"key": key, "title": "fetched"} for key in keys}
+
+        with patch.object(helpers, "make_cards", make_cards):
+            books = helpers.iter_books(
+                ["OL1W", "OL2W", "OL3W", "OL4W", "OL2W", "OL5W"],
+                {"OL1W": "OL1W", "OL4W": "OL4W"}, chunk=2)
+
+            self.assertEqual(next(books)["title"], "row")
+            release.set()
+            rest = list(books)
+
+        self.assertEqual([book["key"] for book in rest],
+                         ["OL2W", "OL3W", "OL4W", "OL2W", "OL5W"])
+        self.assertEqual(sorted(fetched), [["OL2W", "OL3W"], ["OL5W"]])
+        helpers.refresh_books.assert_called_with(["OL2W", "OL3W", "OL5W"])
+
+
+@patch.object(helpers, "start_trending_refresher", lambda: None)
+class TrendingTestCase(TestCase):
+    """Test the stale-while-revalidate trending list."""
+
+    def setUp(self):
+        helpers.cache.clear()
+        helpers._last_trending = None
+
+    def test_serves_cached_copy(self):
+        helpers.cache.set("trending", {"books": ["cached"], "fetched_at": 0})
+
+        with patch.object(helpers, "fetch_trending",
+                          side_effect=AssertionError("no upstream call")):
+            self.assertEqual(helpers.get_trending(), ["cached"])
+
+    def test_refresh_skips_fresh_copy(self):
+        helpers.cache.set("trending",
+                          {"books": ["fresh"], "fetched_at": time.time()})
+
+        with patch.object(helpers, "fetch_trending", return_value=["new"]):
+            self.assertEqual(helpers.refresh_trending()["books"], ["fresh"])
+            self.assertEqual(helpers.refresh_trending(force=True)["books"],
+                             ["new"])
+
+    def test_cold_cache_fetches(self):
+        with patch.object(helpers, "fetch_trending", return_value=["new"]):
+            self.assertEqual(helpers.get_trending(), ["new"])
+
+    def test_eviction_serves_last_copy(self):
+        with patch.object(helpers, "fetch_trending", return_value=["old"]):
+            helpers.get_trending()
+        helpers.cache.clear()
+
+        with patch.object(helpers, "fetch_trending",
+                          side_effect=AssertionError("no upstream call")):
+            self.assertEqual(helpers.get_trending(), ["old"])
+
+    def test_cold_misses_share_a_fetch(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch():
+            started.set()
+            release.wait(5)
+            return ["new"]
+
+        with patch.object(helpers, "fetch_trending",
+                          side_effect=slow_fetch) as fetch:
+            results = []
+            threads = [threading.Thread(
+                target=lambda: results.append(helpers.get_trending()))
+                for _ in range(4)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.05)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        fetch.assert_called_once()
+        self.assertEqual(results, [["new"]] * 4)
+
+    def test_outage_with_nothing_cached_raises(self):
+        with patch.object(helpers, "fetch_trending",
+                          side_effect=requests.ConnectionError):
+            with self.assertRaises(requests.RequestException):
+                helpers.get_trending()
+
+
+class SearchTestCase(TestCase):
+    """Test search caching."""
+
+    def setUp(self):
+        helpers.cache.clear()
+
+    def test_search_key(self):
+        self.assertEqual(helpers.search_key("  Dune  Messiah ", "Title", "15", 1),
+                         ("dune messiah", "title", 15, 1))
+        self.assertEqual(helpers.search_key("dune", "bogus", 15, 1),
+                         ("dune", "title", 15, 1))
+
+    def test_equivalent_searches_share_a_call(self):
+        docs = {"docs": [{"key": "/works/OL1W", "title": "Dune"}]}
+
+        with patch.object(helpers.client, "search", return_value=docs) as search:
+            helpers.search_books("Dune", "title")
+            books = helpers.search_books(" dune", "TITLE")
+
+        search.assert_called_once()
+        self.assertEqual(books[0]["key"], "/books/book/OL1W")
@@ -0,0 +1,109 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+from unittest import TestCase
+
+from flask import Flask, stream_with_context
+
+from instrumentation import (init_metrics, metrics, record_upstream,
+                             RequestTimings, cache_lines, breaker_lines)
+from api_helpers import CircuitBreaker
+from cache import LRUCache, SingleFlight
+from http_caching import init_http_caching
+
+app = Flask(__name__)
+app.config['SERVER_TIMING'] = True
+app.config['METRICS_TOKEN'] = "secret"
+init_metrics(app, collectors=[lambda: ["booklist_extra 1"]])
+init_http_caching(app)
+
+
+@app.route('/books/<key>')
+def book(key):
+    record_upstream(0.25)
+    record_upstream(0.25)
+    return "ok"
+
+
+@app.route('/stream')
+def stream():
+    def body():
+        yield "a"
+        record_upstream(0.5)
+        yield "b"
+
+    return app.response_class(stream_with_context(body()))
+
+
+class MetricsTestCase(TestCase):
+    """Test request timings and /metrics."""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_server_timing(self):
+        resp = self.client.get('/books/OL1W')
+        timing = resp.headers['Server-Timing']
+
+        self.assertIn("app;dur=", timing)
+        self.assertIn('openlibrary;dur=500.0;desc="2 calls"', timing)
+
+    def test_metrics(self):
+        self.client.get('/books/OL1W')
+        resp = self.client.get('/metrics',
+                               headers={"Authorization": "Bearer secret"})
+        body = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('booklist_requests_total{route="/books/<key>",'
+                      'method="GET",status="200"}', body)
+        self.assertIn('booklist_request_duration_seconds_bucket{'
+                      'route="/books/<key>",le="+Inf"}', body)
+        self.assertIn("booklist_extra 1", body)
+        self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
+    def test_metrics_needs_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+
+    def test_histogram_buckets(self):
+        before = metrics.routes.get("/test", {}).get("count", 0)
+        metrics.observe("/test", "GET", 200, 0.03, RequestTimings())
+        stat = metrics.routes["/test"]
+
+        self.assertEqual(stat["count"], before + 1)
+        self.assertEqual(stat["buckets"][metrics.buckets.index(0.025)], 0)
+        self.assertEqual(stat["buckets"][metrics.buckets.index(0.05)], before + 1)
+
+    def test_cache_hit_ratio(self):
+        c = LRUCache()
+        c.set("a", 1)
+        c.get("a")
+        c.get("b")
+        lines = list(cache_lines({"book": c, "off": None},
+                                 {"book": SingleFlight()}))
+
+        self.assertIn('booklist_cache_hit_ratio{cache="book"} 0.5000', lines)
+        self.assertFalse(any('cache="off"' in line for line in lines))
+
+    def test_streamed_response_counted_when_sent(self):
+        resp = self.client.get('/stream')
+        self.assertNotIn("/stream", metrics.routes)
+
+        self.assertEqual(resp.get_data(as_text=True), "ab")
+        resp.close()
+
+        self.assertEqual(metrics.routes["/stream"]["upstream_seconds"], 0.5)
+
+    def test_breaker_state(self):
+        breaker = CircuitBreaker(threshold=1)
+        breaker.failure()
+        lines = list(breaker_lines({"works": breaker}))
+
+        self.assertIn('booklist_openlibrary_circuit_state{endpoint="works",'
+                      'state="open"} 1', lines)
+        self.assertIn('booklist_openlibrary_circuit_trips_total'
+                      '{endpoint="works"} 1', lines)
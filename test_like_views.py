@@ -0,0 +1,228 @@
+"""Like and readers view tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_like_views.py
+
+
+import os
+import re
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.parse import unquote
+
+from models import db, upgrade_db, User, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///the-book-list-test"
+os.environ['BOOK_CACHE_PATH'] = ""
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, CURR_USERNAME_KEY
+
+ctx = app.app_context()
+ctx.push()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['TESTING'] = True
+
+
+def fake_books(keys):
+    return [{"title": f"Title {key}", "published": "2019", "authors": [],
+             "cover": None, "key": key} for key in keys]
+
+
+@patch("app.make_books", fake_books)
+class ReadersViewTestCase(TestCase):
+    """Test the page of what other readers like."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=f"reader{i}",
+                             first_name="Re",
+                             last_name="Ader",
+                             email=f"reader{i}@test.com",
+                             password="password")
+                 for i in range(5)]
+        db.session.commit()
+        self.testuser_id = users[0].id
+
+        # OL2W and OL3W tie on readers; OL5W is only liked by testuser,
+        # whose like of OL4W doesn't count either
+        for user, key in [(1, "OL1W"), (2, "OL1W"), (3, "OL1W"),
+                          (1, "OL2W"), (2, "OL2W"),
+                          (3, "OL3W"), (4, "OL3W"),
+                          (4, "OL4W"), (0, "OL4W"), (0, "OL5W")]:
+            db.session.add(Like(user_id=users[user].id, book_key=key))
+            # one at a time, so like ids follow the list
+            db.session.flush()
+        db.session.commit()
+
+        app.config['STREAM_LIST_PAGES'] = False
+
+    def tearDown(self):
+        resp = super().tearDown()
+        db.session.rollback()
+        app.config['STREAM_LIST_PAGES'] = True
+        app.config['READERS_PAGE_SIZE'] = 24
+        return resp
+
+    def get_page(self, query=""):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_USERNAME_KEY] = "reader0"
+
+            resp = c.get(f"/users/{self.testuser_id}/readers{query}")
+
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        after = re.search(r'after=([^"&]+)"', html)
+        books = re.findall(r"Title (OL\d+W).*?Readers: </strong>(\d+)",
+                           html, re.S)
+
+        return ([(key, int(readers)) for key, readers in books],
+                unquote(after.group(1)) if after else None)
+
+    def test_popular(self):
+        """Most readers first, ties by key, the user's own likes left out."""
+
+        books, after = self.get_page()
+
+        self.assertEqual(books, [("OL1W", 3), ("OL2W", 2), ("OL3W", 2),
+                                 ("OL4W", 1)])
+        self.assertIsNone(after)
+
+    def test_recent(self):
+        """Most recently liked by another reader first."""
+
+        books, after = self.get_page("?order=recent")
+
+        self.assertEqual([key for key, readers in books],
+                         ["OL4W", "OL3W", "OL2W", "OL1W"])
+        self.assertIsNone(after)
+
+    def test_tie_across_pages(self):
+        """A page that ends inside a tie picks up with the rest of it."""
+
+        app.config['READERS_PAGE_SIZE'] = 2
+
+        books, after = self.get_page()
+        self.assertEqual(books, [("OL1W", 3), ("OL2W", 2)])
+        self.assertEqual(after, "2:OL2W")
+
+        books, after = self.get_page(f"?after={after}")
+        self.assertEqual(books, [("OL3W", 2), ("OL4W", 1)])
+        self.assertIsNone(after)
+
+    def test_pages_resume(self):
+        """Following the cursors visits every book once, in order."""
+
+        for order in ("popular", "recent"):
+            everything, _ = self.get_page(f"?order={order}")
+
+            app.config['READERS_PAGE_SIZE'] = 1
+            seen, after = self.get_page(f"?order={order}")
+
+            while after:
+                books, after = self.get_page(f"?order={order}&after={after}")
+                seen += books
+
+            app.config['READERS_PAGE_SIZE'] = 24
+            self.assertEqual(seen, everything)
+
+    def test_bad_cursor(self):
+        """A malformed cursor starts from the first page."""
+
+        for query, first in [("?after=nonsense", "OL1W"),
+                             ("?after=x:OL1W", "OL1W"),
+                             ("?order=recent&after=2:OL2W", "OL4W")]:
+            books, after = self.get_page(query)
+            self.assertEqual(books[0][0], first)
+
+
+@patch("app.save_book_quietly", lambda key: None)
+class LikeViewTestCase(TestCase):
+    """Test liking a book."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    first_name="Test",
+                                    last_name="User",
+                                    email="test@test.com",
+                                    password="testuser")
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def tearDown(self):
+        resp = super().tearDown()
+        db.session.rollback()
+        return resp
+
+    def test_add_once(self):
+        self.assertTrue(Like.add(self.testuser_id, "OL1W"))
+        self.assertFalse(Like.add(self.testuser_id, "OL1W"))
+        db.session.commit()
+
+        self.assertEqual(Like.query.filter_by(book_key="OL1W").count(), 1)
+
+    def test_like_twice(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+                sess[CURR_USERNAME_KEY] = "testuser"
+
+            flashes = []
+            for _ in range(2):
+                resp = c.post("/books/book/OL1W/like")
+                self.assertEqual(resp.status_code, 302)
+
+                with c.session_transaction() as sess:
+                    flashes.append(sess.pop("_flashes")[0][1])
+
+        self.assertIn("added", flashes[0])
+        self.assertIn("already", flashes[1])
+        self.assertEqual(Like.query.count(), 1)
+
+    def test_upgrade_drops_duplicates(self):
+        """upgrade_db keeps the oldest of duplicate likes and then
+        creates the unique index."""
+
+        index = next(index for index in Like.__table__.indexes
+                     if index.unique)
+        index.drop(db.engine)
+
+        for key in ("OL1W", "OL1W", "OL2W", "OL1W"):
+            db.session.add(Like(user_id=self.testuser_id, book_key=key))
+        db.session.commit()
+        first = Like.query.filter_by(book_key="OL1W").order_by(Like.id).first().id
+
+        upgrade_db()
+
+        self.assertEqual([like.id for like in
+                          Like.query.filter_by(book_key="OL1W")], [first])
+        self.assertEqual(Like.query.count(), 2)
+
+        indexes = db.inspect(db.engine).get_indexes("likes")
+        self.assertTrue(any(i["name"] == index.name and i["unique"]
+                            for i in indexes))
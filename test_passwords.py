@@ -0,0 +1,53 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+from unittest import TestCase
+from unittest.mock import patch
+
+import passwords
+from passwords import hash_password, check_password, needs_rehash
+from models import User
+
+
+@patch("passwords.BCRYPT_LOG_ROUNDS", 4)
+class PasswordsTestCase(TestCase):
+    """Test hashing on the bcrypt pool."""
+
+    def test_hash_and_check(self):
+        pw_hash = hash_password("password")
+
+        self.assertTrue(pw_hash.startswith("$2b$04$"))
+        self.assertTrue(check_password(pw_hash, "password"))
+        self.assertFalse(check_password(pw_hash, "wrong"))
+
+    def test_records_queue_time(self):
+        checks = passwords.stats["checks"]
+        check_password(hash_password("password"), "password")
+
+        self.assertEqual(passwords.stats["checks"], checks + 1)
+        self.assertGreaterEqual(passwords.stats["queue_seconds"], 0)
+
+    def test_needs_rehash(self):
+        self.assertFalse(needs_rehash(hash_password("password")))
+        self.assertTrue(needs_rehash("$2b$05$" + "x" * 53))
+        self.assertTrue(needs_rehash("not a hash"))
+
+    def test_rehash_on_login(self):
+        with patch("passwords.BCRYPT_LOG_ROUNDS", 5):
+            user = User(password=hash_password("password"))
+
+        self.assertTrue(user.check_password("password"))
+        self.assertTrue(user.password.startswith("$2b$04$"))
+        self.assertTrue(check_password(user.password, "password"))
+
+    def test_no_rehash_on_wrong_password(self):
+        with patch("passwords.BCRYPT_LOG_ROUNDS", 5):
+            user = User(password=hash_password("password"))
+        old = user.password
+
+        self.assertFalse(user.check_password("wrong"))
+        self.assertEqual(user.password, old)